@@ -0,0 +1,39 @@
+"""create outbox table
+
+Revision ID: 3f9c2a1b7d4e
+Revises:
+Create Date: 2026-10-18 09:12:44.318205
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9c2a1b7d4e'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'Outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('queue', sa.String(length=225), nullable=False),
+        sa.Column('event_name', sa.String(length=225), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('trace_id', sa.String(length=64), nullable=True),
+        sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_outbox_queue_id', 'Outbox', ['queue', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_outbox_queue_id', table_name='Outbox')
+    op.drop_table('Outbox')
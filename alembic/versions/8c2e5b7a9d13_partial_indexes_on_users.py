@@ -0,0 +1,49 @@
+"""partial indexes on users
+
+The indexes are built CONCURRENTLY outside of a transaction, so writes to
+Users keep going while they build. A failed concurrent build leaves an
+INVALID index behind, drop it and run the upgrade again. The full unique
+constraints are only dropped once their partial replacements exist.
+
+Emails are unique case insensitively, so existing rows that differ only
+in case have to be merged or soft deleted first, otherwise the email
+index fails to build.
+
+Revision ID: 8c2e5b7a9d13
+Revises: 3f9c2a1b7d4e
+Create Date: 2026-10-18 14:03:27.906113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c2e5b7a9d13'
+down_revision: Union[str, None] = '3f9c2a1b7d4e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ACTIVE = sa.text('is_deleted = false')
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('uq_user_email_active', 'Users', [sa.text('lower(email)')], unique=True,
+                        postgresql_where=ACTIVE, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('uq_user_phone_active', 'Users', ['phone'], unique=True, postgresql_where=ACTIVE,
+                        postgresql_concurrently=True, if_not_exists=True)
+    op.execute('ALTER TABLE "Users" DROP CONSTRAINT IF EXISTS "Users_email_key"')
+    op.execute('ALTER TABLE "Users" DROP CONSTRAINT IF EXISTS "Users_phone_key"')
+    op.execute('ALTER TABLE "Users" RENAME CONSTRAINT "Users_pkey" TO pk_user_id')
+
+
+def downgrade() -> None:
+    op.execute('ALTER TABLE "Users" RENAME CONSTRAINT pk_user_id TO "Users_pkey"')
+    op.create_unique_constraint('Users_email_key', 'Users', ['email'])
+    op.create_unique_constraint('Users_phone_key', 'Users', ['phone'])
+    with op.get_context().autocommit_block():
+        op.drop_index('uq_user_phone_active', table_name='Users', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('uq_user_email_active', table_name='Users', postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,65 @@
+import time
+from typing import Dict, List
+
+from jose import JWTError
+from sqlalchemy import false, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.internal.schema import TokenIntrospection
+from app.user.models import Users
+from utils import cache, jwt_token
+from utils.jwks import UnknownKeyError
+from utils.variables import PRINCIPAL_CACHE_TTL
+
+INACTIVE = TokenIntrospection(active=False)
+
+
+async def introspect_tokens_async(session: AsyncSession, tokens: List[str]) -> List[TokenIntrospection]:
+    """Introspect a batch of access tokens, answering in the order they were given.
+
+    Every distinct token is verified once and all their subjects are looked
+    up with a single IN query. Results are memoized by token digest until
+    the token expires. A token whose user is missing or whose key this
+    worker has not loaded yet is only memoized for as long as a cached
+    principal would live.
+    """
+    digests = [cache.token_digest(token) for token in tokens]
+    results: Dict[str, TokenIntrospection] = {}
+    claims: Dict[str, dict] = {}
+    for digest, token in zip(digests, tokens):
+        if digest in results or digest in claims:
+            continue
+        cached = cache.introspection_cache.get(digest)
+        if cached is not None:
+            results[digest] = cached
+            continue
+        try:
+            claims[digest] = jwt_token.decode_access_token(token)
+        except UnknownKeyError:
+            # Possibly signed with a key rotated in since this worker last read the keys.
+            results[digest] = INACTIVE
+            cache.introspection_cache.set(digest, INACTIVE, ttl=PRINCIPAL_CACHE_TTL)
+        except JWTError:
+            # A bad or expired token never becomes valid, keep the answer as long as the cache allows.
+            results[digest] = INACTIVE
+            cache.introspection_cache.set(digest, INACTIVE)
+
+    subjects = {payload["sub"].lower() for payload in claims.values() if payload.get("sub")}
+    known = set()
+    if subjects:
+        rows = await session.execute(
+            select(func.lower(Users.email)).where(func.lower(Users.email).in_(subjects), Users.is_deleted == false())
+        )
+        known = set(rows.scalars().all())
+
+    now = time.time()
+    for digest, payload in claims.items():
+        if payload.get("sub") and payload["sub"].lower() in known:
+            result = TokenIntrospection(active=True, sub=payload["sub"], exp=payload.get("exp"))
+            ttl = payload["exp"] - now if payload.get("exp") else None
+        else:
+            result, ttl = INACTIVE, PRINCIPAL_CACHE_TTL
+        results[digest] = result
+        cache.introspection_cache.set(digest, result, ttl=ttl)
+
+    return [results[digest] for digest in digests]
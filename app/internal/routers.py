@@ -0,0 +1,118 @@
+from typing import Optional
+
+from fastapi import status, APIRouter, Depends, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.internal.queries import introspect_tokens_async
+from app.internal.schema import IntrospectionRequest
+from utils import response, jwt_token, metrics, OAuth2
+from utils.database import get_async_db, get_pool_status
+from utils.profiler import memory_snapshots, profiler
+from utils.variables import PROFILE_MAX_SECONDS
+from utils.watchdog import watchdog
+
+# Every internal endpoint can slow the worker down or expose its internals, all require the internal token.
+router = APIRouter(
+    prefix="/internal",
+    tags=['internal'],
+    dependencies=[Depends(OAuth2.verify_internal_token)]
+)
+
+# Prometheus expects /metrics at the root, so it is not under the /internal prefix.
+metrics_router = APIRouter(tags=['internal'])
+
+
+@router.get('/db/pool', summary='Get database connection pool statistics')
+async def db_pool_stats() -> dict:
+    return response.success(
+        status_code=status.HTTP_200_OK,
+        message='Database pool statistics retrieved successfully.',
+        data=get_pool_status(),
+        warning=None
+    )
+
+
+@router.get('/hashing', summary='Get password hashing pool statistics')
+async def hashing_stats() -> dict:
+    return response.success(
+        status_code=status.HTTP_200_OK,
+        message='Hashing pool statistics retrieved successfully.',
+        data={**jwt_token.hashing_pool.stats(), "password_hash": jwt_token.password_settings},
+        warning=None
+    )
+
+
+@router.get('/watchdog', summary='Get event loop stalls by call site')
+async def watchdog_stats() -> dict:
+    return response.success(
+        status_code=status.HTTP_200_OK,
+        message='Event loop watchdog statistics retrieved successfully.',
+        data=watchdog.stats(),
+        warning=None
+    )
+
+
+@router.get('/profile', summary='Sample every thread and return collapsed stacks')
+async def cpu_profile(seconds: float = Query(default=10, gt=0, le=PROFILE_MAX_SECONDS)) -> Response:
+    profile = await profiler.profile(seconds)
+    return Response(
+        content=profile.collapsed(),
+        media_type="text/plain",
+        headers={"Content-Disposition": "attachment; filename=profile.folded"}
+    )
+
+
+@router.get('/profile/requests/{trace_id}', summary='Collapsed stacks of a request sent with X-Profile')
+async def request_profile(trace_id: str) -> Response:
+    return Response(content=profiler.request_profile(trace_id).collapsed(), media_type="text/plain")
+
+
+@router.post('/profile/memory/snapshots', summary='Take a tracemalloc snapshot')
+def take_memory_snapshot(limit: int = Query(default=25, gt=0)) -> dict:
+    return response.success(
+        status_code=status.HTTP_201_CREATED,
+        message='Memory snapshot taken successfully.',
+        data=memory_snapshots.take(limit),
+        warning=None
+    )
+
+
+@router.get('/profile/memory/diff', summary='Diff two tracemalloc snapshots by file and line')
+def memory_diff(start: int, end: Optional[int] = None, limit: int = Query(default=25, gt=0)) -> dict:
+    if end is None:
+        end = memory_snapshots.take(limit)["id"]
+    return response.success(
+        status_code=status.HTTP_200_OK,
+        message='Memory snapshot diff retrieved successfully.',
+        data=memory_snapshots.diff(start, end, limit),
+        warning=None
+    )
+
+
+@router.delete('/profile/memory', summary='Stop tracemalloc and drop its snapshots')
+def stop_memory_tracing() -> dict:
+    memory_snapshots.stop()
+    return response.success(
+        status_code=status.HTTP_200_OK,
+        message='Memory tracing stopped successfully.',
+        data=None,
+        warning=None
+    )
+
+
+@router.post('/tokens/introspect', summary='Introspect a batch of access tokens')
+async def introspect_tokens(data: IntrospectionRequest, session: AsyncSession = Depends(get_async_db)) -> dict:
+    return response.success(
+        status_code=status.HTTP_200_OK,
+        message='Tokens introspected successfully.',
+        data=await introspect_tokens_async(session=session, tokens=data.tokens),
+        warning=None
+    )
+
+
+@metrics_router.get('/metrics', summary='Prometheus metrics', include_in_schema=False)
+def prometheus_metrics() -> Response:
+    return Response(
+        content=metrics.registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
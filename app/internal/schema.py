@@ -0,0 +1,15 @@
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+from utils.variables import INTROSPECTION_MAX_TOKENS
+
+
+class IntrospectionRequest(BaseModel):
+    tokens: List[str] = Field(min_length=1, max_length=INTROSPECTION_MAX_TOKENS)
+
+
+class TokenIntrospection(BaseModel):
+    active: bool
+    sub: Optional[str] = None
+    exp: Optional[int] = None
@@ -0,0 +1,119 @@
+"""Where the outbox relay publishes to.
+
+A broker takes a batch of message bodies for one queue and either accepts
+all of them or raises, the relay only deletes outbox rows after that.
+"""
+import asyncio
+import sqlite3
+from collections import defaultdict
+from typing import Dict, List
+from urllib.parse import urlparse
+
+
+class Broker:
+    async def connect(self) -> None:
+        pass
+
+    async def publish(self, queue: str, bodies: List[bytes]) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemoryBroker(Broker):
+    """Keeps published bodies in memory, for tests."""
+
+    def __init__(self):
+        self.queues: Dict[str, List[bytes]] = defaultdict(list)
+
+    async def publish(self, queue: str, bodies: List[bytes]) -> None:
+        self.queues[queue].extend(bodies)
+
+
+class SQLiteBroker(Broker):
+    """Appends bodies to a table of a local SQLite file, a stand-in for RabbitMQ in development."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+
+    async def connect(self) -> None:
+        self.connection = await asyncio.to_thread(sqlite3.connect, self.path, check_same_thread=False)
+        await asyncio.to_thread(
+            self.connection.execute,
+            "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, queue TEXT NOT NULL, body BLOB NOT NULL)"
+        )
+
+    async def publish(self, queue: str, bodies: List[bytes]) -> None:
+        await asyncio.to_thread(self._insert, queue, bodies)
+
+    def _insert(self, queue: str, bodies: List[bytes]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO messages (queue, body) VALUES (?, ?)", [(queue, body) for body in bodies]
+            )
+
+    def messages(self, queue: str) -> List[bytes]:
+        rows = self.connection.execute("SELECT body FROM messages WHERE queue = ? ORDER BY id", (queue,))
+        return [row[0] for row in rows]
+
+    async def close(self) -> None:
+        if self.connection is not None:
+            await asyncio.to_thread(self.connection.close)
+            self.connection = None
+
+
+class AmqpBroker(Broker):
+    """RabbitMQ over one robust connection and channel, kept open for the life of the relay.
+
+    Messages are persistent and the channel runs in publisher confirm mode,
+    publish() returns once the broker confirmed the whole batch.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.connection = None
+        self.channel = None
+        self.declared = set()
+
+    async def connect(self) -> None:
+        import aio_pika
+
+        self.connection = await aio_pika.connect_robust(self.url)
+        self.channel = await self.connection.channel(publisher_confirms=True)
+
+    async def publish(self, queue: str, bodies: List[bytes]) -> None:
+        import aio_pika
+
+        if queue not in self.declared:
+            await self.channel.declare_queue(queue, durable=True)
+            self.declared.add(queue)
+        await asyncio.gather(*(
+            self.channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=body,
+                    content_type="application/json",
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                ),
+                routing_key=queue,
+            )
+            for body in bodies
+        ))
+
+    async def close(self) -> None:
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+
+
+def get_broker(url: str) -> Broker:
+    """memory://, sqlite:///<path> or amqp(s)://user:password@host/vhost."""
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return InMemoryBroker()
+    if scheme == "sqlite":
+        return SQLiteBroker(url[len("sqlite:///"):])
+    if scheme in ("amqp", "amqps"):
+        return AmqpBroker(url)
+    raise ValueError(f"Unsupported broker url {url!r}")
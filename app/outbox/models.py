@@ -0,0 +1,32 @@
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    String,
+    Text,
+    func
+)
+
+from utils.database import Base
+
+
+class OutboxMessage(Base):
+    """Event waiting to be published, written in the transaction that caused it.
+
+    The relay deletes a row once the broker accepted it, so the table only
+    holds what is still pending.
+    """
+    __tablename__ = "Outbox"
+    id = Column(Integer, nullable=False, primary_key=True)
+    queue = Column(String(225), nullable=False)
+    event_name = Column(String(225), nullable=False)
+    payload = Column(Text, nullable=False)
+    trace_id = Column(String(64), nullable=True)
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_outbox_queue_id", "queue", "id"),
+    )
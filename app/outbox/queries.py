@@ -0,0 +1,43 @@
+from typing import List
+
+from pydantic import BaseModel
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.outbox.models import OutboxMessage
+from utils.log import trace_id_var
+
+
+def enqueue(session: AsyncSession, queue: str, event: BaseModel) -> OutboxMessage:
+    """Stage `event` for publishing, it is committed (or rolled back) with the rest of the session."""
+    message = OutboxMessage(
+        queue=queue,
+        event_name=getattr(event, "event_name", type(event).__name__),
+        payload=event.json(),
+        trace_id=trace_id_var.get() or None,
+    )
+    session.add(message)
+    return message
+
+
+async def claim_pending_async(session: AsyncSession, limit: int) -> List[OutboxMessage]:
+    """Oldest pending messages, locked so concurrent relays pick disjoint batches."""
+    result = await session.execute(
+        select(OutboxMessage)
+        .order_by(OutboxMessage.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return list(result.scalars().all())
+
+
+async def delete_published_async(session: AsyncSession, ids: List[int]) -> None:
+    await session.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(ids)))
+
+
+async def record_failure_async(session: AsyncSession, ids: List[int], error: str) -> None:
+    await session.execute(
+        update(OutboxMessage)
+        .where(OutboxMessage.id.in_(ids))
+        .values(attempts=OutboxMessage.attempts + 1, last_error=error)
+    )
@@ -0,0 +1,107 @@
+"""Publishes the outbox to the broker, run next to the API workers:
+
+    python -m app.outbox.relay
+
+Each batch is claimed with FOR UPDATE SKIP LOCKED, so several relays can
+run side by side. Rows are deleted in the same transaction once the broker
+confirmed them, a crash in between publishes them again: delivery is at
+least once and consumers have to tolerate duplicates.
+"""
+import asyncio
+import signal
+
+from app.outbox import queries
+from app.outbox.brokers import Broker, get_broker
+from utils import metrics, store
+from utils.database import connect_to_async_database, disconnect_from_async_database
+from utils.log import StructuredMessage, logger
+from utils.variables import OUTBOX_BATCH_SIZE, OUTBOX_BROKER_URL, OUTBOX_POLL_INTERVAL
+
+
+class OutboxRelay:
+    def __init__(self, session_factory, broker: Broker, batch_size: int = 100, poll_interval: float = 0.5,
+                 max_backoff: float = 60):
+        self.session_factory = session_factory
+        self.broker = broker
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+
+    async def relay_batch(self) -> int:
+        """Publish one batch, returns how many messages were published."""
+        published, error = [], None
+        async with self.session_factory() as session:
+            async with session.begin():
+                messages = await queries.claim_pending_async(session, self.batch_size)
+                by_queue = {}
+                for message in messages:
+                    by_queue.setdefault(message.queue, []).append(message)
+
+                for queue, batch in by_queue.items():
+                    try:
+                        await self.broker.publish(queue, [message.payload.encode() for message in batch])
+                    except Exception as e:
+                        error = e
+                        break
+                    published.extend(message.id for message in batch)
+                    metrics.OUTBOX_PUBLISHED.labels(queue).inc(len(batch))
+
+                if published:
+                    await queries.delete_published_async(session, published)
+                if error is not None:
+                    done = set(published)
+                    failed = [message.id for message in messages if message.id not in done]
+                    await queries.record_failure_async(session, failed, repr(error)[:1000])
+                    metrics.OUTBOX_FAILURES.inc(len(failed))
+
+        if error is not None:
+            raise error
+        return len(published)
+
+    async def run(self, stop: asyncio.Event) -> None:
+        await self.broker.connect()
+        backoff = self.poll_interval
+        try:
+            while not stop.is_set():
+                try:
+                    relayed = await self.relay_batch()
+                except Exception as e:
+                    logger.error(StructuredMessage("Outbox relay failed", {"error": repr(e), "retry_in": backoff}))
+                    wait, backoff = backoff, min(backoff * 2, self.max_backoff)
+                else:
+                    backoff = self.poll_interval
+                    if relayed == self.batch_size:
+                        continue  # more is probably waiting, keep draining
+                    wait = self.poll_interval
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.broker.close()
+
+
+async def main() -> None:
+    await logger.start()
+    connect_to_async_database()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    relay = OutboxRelay(
+        session_factory=store.async_session,
+        broker=get_broker(OUTBOX_BROKER_URL),
+        batch_size=OUTBOX_BATCH_SIZE,
+        poll_interval=OUTBOX_POLL_INTERVAL,
+    )
+    logger.info(f"Outbox relay started, publishing to {OUTBOX_BROKER_URL.rsplit('@', 1)[-1]}")
+    try:
+        await relay.run(stop)
+    finally:
+        await disconnect_from_async_database()
+        await logger.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,8 +3,10 @@ from sqlalchemy import (
     String,
     Integer,
     Boolean,
-    UniqueConstraint,
-    PrimaryKeyConstraint
+    Index,
+    PrimaryKeyConstraint,
+    func,
+    text
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy_serializer import SerializerMixin
@@ -18,15 +20,22 @@ class Users(Base, Common, SerializerMixin):
     __tablename__ = "Users"
     serialize_only = ('id', 'email', 'full_name', 'phone', 'address')
     id = Column(Integer, nullable=False, primary_key=True)
-    phone = Column(String(15), nullable=False, unique=True)
+    phone = Column(String(15), nullable=False)
     full_name = Column(String(225), nullable=False)
-    email = Column(String(225), nullable=False, unique=True)
+    email = Column(String(225), nullable=False)
     password = Column(String, nullable=False)
     address = Column(String(225), nullable=False)
     is_active = Column(Boolean, default=False)
 
-    UniqueConstraint("email", name="uq_user_email")
-    PrimaryKeyConstraint("id", name="pk_user_id")
+    # Email (case insensitively) and phone are unique among the users that are not deleted,
+    # the lookups filter on the same expressions and predicate.
+    __table_args__ = (
+        PrimaryKeyConstraint("id", name="pk_user_id"),
+        Index("uq_user_email_active", func.lower(email), unique=True,
+              postgresql_where=text("is_deleted = false"), sqlite_where=text("is_deleted = 0")),
+        Index("uq_user_phone_active", "phone", unique=True,
+              postgresql_where=text("is_deleted = false"), sqlite_where=text("is_deleted = 0")),
+    )
 
     class Config:
         orm_mode = True
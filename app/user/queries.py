@@ -1,7 +1,11 @@
 from pydantic import EmailStr
+from sqlalchemy import false, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.user.models import Users
-from utils import store, jwt_token
+from app.user.reads import email_taken_statement, unique_fields_statement
+from utils import cache, store, jwt_token
 from utils.exceptions import GenericError
 
 
@@ -19,7 +23,7 @@ def get_user_or_404(user_id):
 
 
 def get_user_by_email_or_404(email):
-    user = Users.query.filter_by(email=email, is_deleted=False).first()
+    user = Users.query.filter(func.lower(Users.email) == func.lower(email), Users.is_deleted == false()).first()
     if not user:
         raise GenericError(
             status_code=404,
@@ -37,7 +41,7 @@ def get_user_by_email_or_404(email):
 
 
 def get_user_by_phone_or_404(phone):
-    user = Users.query.filter_by(phone=phone).first()
+    user = Users.query.filter(Users.phone == phone, Users.is_deleted == false()).first()
 
     if user and not user.is_deleted:
         raise GenericError(
@@ -50,12 +54,26 @@ def get_user_by_phone_or_404(phone):
 
 
 def check_existing_user(email):
-    user = Users.query.filter_by(email=email).first()
-    if user and not user.is_deleted:
+    if store.session.execute(email_taken_statement(email)).first():
+        raise GenericError(
+            status_code=409,
+            message=f'User with email {email} already exists',
+        )
+
+
+def ensure_user_fields_available(rows, email, phone):
+    """Raise the same errors the email and phone checks did, email first."""
+    if any(row.email.lower() == email.lower() for row in rows):
         raise GenericError(
             status_code=409,
             message=f'User with email {email} already exists',
         )
+    if any(row.phone == phone for row in rows):
+        raise GenericError(
+            status_code=404,
+            message="Phone number already registered.",
+            errors={'phone': f'{phone} already registered.'}
+        )
 
 
 def create_user(user):
@@ -75,10 +93,11 @@ def update_user(user, data):
     for field, value in updated_user.items():
         setattr(user, field, value)
     store.session.commit()
+    cache.invalidate_principal(user.email)
 
 
 def verify_user(email: EmailStr):
-    user = Users.query.filter_by(email=email).first()
+    user = Users.query.filter(func.lower(Users.email) == func.lower(email), Users.is_deleted == false()).first()
     if user.is_active:
         raise GenericError(
             message='User is already active.',
@@ -86,9 +105,145 @@ def verify_user(email: EmailStr):
         )
     user.is_active = True
     store.session.commit()
+    cache.invalidate_principal(email)
 
 
 def change_password(user, password):
     hashed_password = jwt_token.get_hashed_password(password)
     user.password = hashed_password
     store.session.commit()
+    cache.invalidate_principal(user.email)
+
+
+async def get_user_or_404_async(session: AsyncSession, user_id):
+    user = await session.get(Users, user_id)
+
+    if user and not user.is_deleted:
+        return user
+
+    else:
+        raise GenericError(
+            status_code=404,
+            message='User not found'
+        )
+
+
+async def get_user_by_email_or_404_async(session: AsyncSession, email):
+    result = await session.execute(
+        select(Users).where(func.lower(Users.email) == func.lower(email), Users.is_deleted == false())
+    )
+    user = result.scalars().first()
+    if not user:
+        raise GenericError(
+            status_code=404,
+            message="User not found",
+            errors={'email': f'{email} not found'}
+        )
+
+    if not user.is_active:
+        raise GenericError(
+            status_code=404,
+            message='User not active'
+        )
+
+    return user
+
+
+async def get_user_by_phone_or_404_async(session: AsyncSession, phone):
+    result = await session.execute(select(Users).where(Users.phone == phone, Users.is_deleted == false()))
+    user = result.scalars().first()
+
+    if user and not user.is_deleted:
+        raise GenericError(
+            status_code=404,
+            message="Phone number already registered.",
+            errors={'phone': f'{phone} already registered.'}
+        )
+    else:
+        return user
+
+
+async def check_existing_user_async(session: AsyncSession, email):
+    if (await session.execute(email_taken_statement(email))).first():
+        raise GenericError(
+            status_code=409,
+            message=f'User with email {email} already exists',
+        )
+
+
+async def check_user_uniqueness_async(session: AsyncSession, email, phone):
+    """Email and phone availability in a single SELECT."""
+    rows = (await session.execute(unique_fields_statement(email, phone))).all()
+    ensure_user_fields_available(rows, email, phone)
+
+
+async def create_user_async(session: AsyncSession, user, commit: bool = True):
+    """Insert the user, with commit=False it is only flushed so the caller can add to the same transaction."""
+    hashed_password = await jwt_token.get_hashed_password_async(user.password)
+    user_data = user.dict()
+    user_data['password'] = hashed_password
+    user_data.pop('confirm_password', None)
+    new_user = Users(**user_data)
+    new_user.is_active = False
+    session.add(new_user)
+    try:
+        if commit:
+            await session.commit()
+        else:
+            await session.flush()
+    except IntegrityError:
+        # Lost a race against a concurrent signup, the unique constraints have the final say.
+        await session.rollback()
+        raise GenericError(
+            status_code=409,
+            message=f'User with email {user.email} or phone {user.phone} already exists',
+        )
+    return new_user
+
+
+async def update_user_async(session: AsyncSession, user, data):
+    updated_user = data.dict(exclude_none=True)
+    for field, value in updated_user.items():
+        setattr(user, field, value)
+    await session.commit()
+    cache.invalidate_principal(user.email)
+
+
+async def verify_user_async(session: AsyncSession, email: EmailStr):
+    result = await session.execute(
+        select(Users).where(func.lower(Users.email) == func.lower(email), Users.is_deleted == false())
+    )
+    user = result.scalars().first()
+    if user.is_active:
+        raise GenericError(
+            message='User is already active.',
+            status_code=409
+        )
+    user.is_active = True
+    await session.commit()
+    cache.invalidate_principal(email)
+
+
+async def change_password_async(session: AsyncSession, user, password):
+    hashed_password = await jwt_token.get_hashed_password_async(password)
+    user.password = hashed_password
+    await session.commit()
+    cache.invalidate_principal(user.email)
+
+
+async def update_password_hash_async(session: AsyncSession, email, old_hash: str, hashed_password: str) -> bool:
+    """Swap in a rehash of the same password, unless the password changed since `old_hash` was verified.
+
+    Nothing cached depends on the hash. Returns whether the row was updated.
+    """
+    result = await session.execute(
+        update(Users)
+        .where(
+            func.lower(Users.email) == func.lower(email),
+            Users.is_deleted == false(),
+            Users.password == old_hash
+        )
+        .values(password=hashed_password)
+    )
+    await session.commit()
+    return result.rowcount == 1
@@ -0,0 +1,91 @@
+"""Column projected reads for the hot user lookups.
+
+The statements are lambda_stmt()s, so SQLAlchemy builds and compiles each
+one once per call site and later calls only bind their parameters. Rows
+land in small __slots__ objects instead of hydrated, identity mapped
+Users instances. Whatever is going to change a user still loads a Users.
+
+Every lookup filters on `is_deleted = false` as a literal, not a bound
+parameter, so Postgres can match it against the partial indexes on Users
+even with a generic prepared statement plan. Emails are compared
+lowercased, the same way their unique index is defined.
+"""
+from typing import Optional
+
+from sqlalchemy import false, func, lambda_stmt, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.user.models import Users
+from utils.exceptions import GenericError
+
+
+class ReadModel:
+    """Plain row object, built positionally from a row with its __slots__ as the selected columns."""
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if name != "password")
+        return f"{type(self).__name__}({fields})"
+
+
+class LoginUser(ReadModel):
+    """What login and forget password need, UserRegisterResponse plus the hash and the active flag."""
+    __slots__ = ("email", "full_name", "phone", "address", "password", "is_active")
+
+
+class Principal(ReadModel):
+    """The columns of UserDetails."""
+    __slots__ = ("id", "full_name", "email", "created_at", "address", "phone")
+
+
+def login_user_statement(email):
+    return lambda_stmt(lambda: select(
+        Users.email, Users.full_name, Users.phone, Users.address, Users.password, Users.is_active
+    ).where(func.lower(Users.email) == func.lower(email), Users.is_deleted == false()).limit(1))
+
+
+def principal_statement(email):
+    return lambda_stmt(lambda: select(
+        Users.id, Users.full_name, Users.email, Users.created_at, Users.address, Users.phone
+    ).where(func.lower(Users.email) == func.lower(email), Users.is_deleted == false()).limit(1))
+
+
+def email_taken_statement(email):
+    return lambda_stmt(lambda: select(Users.id).where(
+        func.lower(Users.email) == func.lower(email), Users.is_deleted == false()
+    ).limit(1))
+
+
+def unique_fields_statement(email, phone):
+    return lambda_stmt(lambda: select(Users.email, Users.phone).where(
+        or_(func.lower(Users.email) == func.lower(email), Users.phone == phone),
+        Users.is_deleted == false()
+    ))
+
+
+async def get_login_user_async(session: AsyncSession, email) -> LoginUser:
+    """Same checks and errors as get_user_by_email_or_404_async."""
+    row = (await session.execute(login_user_statement(email))).first()
+    if row is None:
+        raise GenericError(
+            status_code=404,
+            message="User not found",
+            errors={'email': f'{email} not found'}
+        )
+
+    user = LoginUser(*row)
+    if not user.is_active:
+        raise GenericError(
+            status_code=404,
+            message='User not active'
+        )
+    return user
+
+
+async def get_principal_async(session: AsyncSession, email) -> Optional[Principal]:
+    row = (await session.execute(principal_statement(email))).first()
+    return Principal(*row) if row is not None else None
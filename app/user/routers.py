@@ -1,11 +1,16 @@
-from app.events.producer_functions import email_verification_procedure, forget_password_verification_procedure
 from app.events.schema import RegisterEmailEvent, ForgotPasswordEvent
-from fastapi import status, APIRouter, BackgroundTasks, Depends
+from typing import Optional
 
+from fastapi import status, APIRouter, Depends, Header, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.outbox import queries as outbox
 from app.user.queries import *
+from app.user.reads import get_login_user_async
 from app.user.schema import *
 from app.user.utils import verify_signup_otp, verify_forget_password_otp
-from utils import response, jwt_token, OAuth2, log, variables
+from utils import admission, response, jwt_token, OAuth2, log, variables
+from utils.database import get_async_db, release_connection
 from utils.otp import otp
 
 router = APIRouter(
@@ -13,34 +18,36 @@ router = APIRouter(
     tags=['authentication and authorization']
 )
 
+jwks_router = APIRouter(tags=['authentication and authorization'])
+
 
 @router.post('/signup', status_code=status.HTTP_201_CREATED, response_model=UserRegisterResponse)
-async def signup(user: UserRegister, background_tasks: BackgroundTasks = BackgroundTasks()) -> UserRegisterResponse:
-    user = create_user(user=user)
+async def signup(user: UserRegister, session: AsyncSession = Depends(get_async_db)) -> UserRegisterResponse:
+    await check_user_uniqueness_async(session=session, email=user.email, phone=user.phone)
+    await release_connection(session)
+    # The verification email goes through the outbox, committed together with the user.
+    user = await create_user_async(session=session, user=user, commit=False)
     event_data = RegisterEmailEvent(
         trace_id=log.trace_id_var.get(),
         to=user.email,
         event_name=variables.REGISTER_EMAIL,
-        otp=otp.generate_otp(user_email=user.email),
+        otp=await otp.generate_otp(user_email=user.email),
         full_name=user.full_name
     )
-    background_tasks.add_task(
-        email_verification_procedure,
-        data=event_data.json(),
-        queue=variables.EMAIL_QUEUE
-    )
+    outbox.enqueue(session, queue=variables.EMAIL_QUEUE, event=event_data)
+    await session.commit()
     data = UserRegisterResponse.from_orm(user)
     return response.success(
         status_code=status.HTTP_201_CREATED,
         message='User created successfully, please check your email for verification.',
-        data=data.dict(),
+        data=data,
         warning=None
     )
 
 
 @router.post('/verify/otp/', status_code=status.HTTP_200_OK)
-async def verify_email(data: OTPVerification) -> dict:
-    verify_signup_otp(code=data.otp, email=data.email)
+async def verify_email(data: OTPVerification, session: AsyncSession = Depends(get_async_db)) -> dict:
+    await verify_signup_otp(session=session, code=data.otp, email=data.email)
     return response.success(
         status_code=status.HTTP_200_OK,
         message='Email verified successfully.',
@@ -50,19 +57,31 @@ async def verify_email(data: OTPVerification) -> dict:
 
 
 @router.post('/login', status_code=status.HTTP_200_OK, response_model=LoginResponse)
-async def login(user_in: UserLogin) -> LoginResponse:
-    user = get_user_by_email_or_404(user_in.email)
-    jwt_token.verify_password(
+async def login(user_in: UserLogin, request: Request,
+                session: AsyncSession = Depends(get_async_db)) -> LoginResponse:
+    if admission.login_admission is not None:
+        # Before the lookup and the hash, a refused attempt costs one Redis round trip.
+        await admission.login_admission.admit(
+            email=user_in.email.lower(),
+            ip=request.client.host if request.client else None
+        )
+    user = await get_login_user_async(session=session, email=user_in.email)
+    await release_connection(session)
+    new_hash = await jwt_token.verify_password_and_rehash_async(
         password=user_in.password,
         hashed_pass=user.password
     )
+    if new_hash is not None:
+        # Hashed with an older or cheaper policy, replace it while we have the plain password.
+        await update_password_hash_async(session=session, email=user.email, old_hash=user.password,
+                                         hashed_password=new_hash)
     login_response = LoginResponse(access_token=jwt_token.create_access_token(user.email),
                                    refresh_token=jwt_token.create_refresh_token(user.email),
                                    user=UserRegisterResponse.from_orm(user))
     return response.success(
         status_code=status.HTTP_200_OK,
         message='Login successful',
-        data=login_response.dict(),
+        data=login_response,
         warning=None
     )
 
@@ -75,37 +94,34 @@ async def refresh_token(token: RefreshTokenRequest) -> TokenResponse:
     return response.success(
         status_code=status.HTTP_200_OK,
         message='Token created successfully',
-        data=response_token.dict(),
+        data=response_token,
         warning=None
     )
 
 
 @router.get('/me', summary='Get details of currently logged in user', response_model=UserDetails)
-async def get_me(user: Users = Depends(OAuth2.get_current_user)) -> UserDetails:
-    response_detail = UserDetails.from_orm(user)
+async def get_me(response_detail: UserDetails = Depends(OAuth2.get_current_principal)) -> UserDetails:
     return response.success(
         status_code=status.HTTP_200_OK,
         message="User details retrieved successfully.",
-        data=response_detail.dict(),
+        data=response_detail,
         warning=None
     )
 
 
 @router.post('/forget/password')
-async def forget_password(user_email: EmailSchema, background_tasks: BackgroundTasks = BackgroundTasks()) -> dict:
-    user = get_user_by_email_or_404(user_email.email)
+async def forget_password(user_email: EmailSchema, session: AsyncSession = Depends(get_async_db)) -> dict:
+    user = await get_login_user_async(session=session, email=user_email.email)
+    await release_connection(session)
     event_data = ForgotPasswordEvent(
         trace_id=log.trace_id_var.get(),
         to=user.email,
         event_name=variables.FORGET_PASSWORD_EMAIL,
-        otp=otp.generate_otp(user_email=user.email),
+        otp=await otp.generate_otp(user_email=user.email),
         full_name=user.full_name
     )
-    background_tasks.add_task(
-        forget_password_verification_procedure,
-        data=event_data.json(),
-        queue=variables.EMAIL_QUEUE
-    )
+    outbox.enqueue(session, queue=variables.EMAIL_QUEUE, event=event_data)
+    await session.commit()
     return response.success(
         status_code=status.HTTP_200_OK,
         message='Forget password email with OTP has been sent.',
@@ -115,10 +131,11 @@ async def forget_password(user_email: EmailSchema, background_tasks: BackgroundT
 
 
 @router.post('/validate/forget/password')
-async def forget_password_validate(data: ForgetPasswordRequest):
-    user = get_user_by_email_or_404(data.email)
-    verify_forget_password_otp(code=data.otp, email=data.email)
-    change_password(user=user, password=data.password)
+async def forget_password_validate(data: ForgetPasswordRequest, session: AsyncSession = Depends(get_async_db)):
+    user = await get_user_by_email_or_404_async(session=session, email=data.email)
+    await release_connection(session)
+    await verify_forget_password_otp(code=data.otp, email=data.email)
+    await change_password_async(session=session, user=user, password=data.password)
     return response.success(
         status_code=status.HTTP_200_OK,
         message='Password changed successfully',
@@ -129,10 +146,15 @@ async def forget_password_validate(data: ForgetPasswordRequest):
 
 @router.post('/change/password')
 async def change_user_password(data: ChangePasswordRequest,
-                               current_user: Users = Depends(OAuth2.get_current_user)) -> dict:
-    jwt_token.verify_password(password=data.current_password, hashed_pass=current_user.password)
-    jwt_token.compare_passwords(new_password=data.new_password, old_hashed_password=current_user.password)
-    change_password(user=current_user, password=data.new_password)
+                               current_user: Users = Depends(OAuth2.get_current_user),
+                               session: AsyncSession = Depends(get_async_db)) -> dict:
+    await release_connection(session)
+    await jwt_token.verify_password_change_async(
+        current_password=data.current_password,
+        new_password=data.new_password,
+        hashed_pass=current_user.password
+    )
+    await change_password_async(session=session, user=current_user, password=data.new_password)
     return response.success(
         status_code=status.HTTP_200_OK,
         message='Password changed successfully',
@@ -142,11 +164,24 @@ async def change_user_password(data: ChangePasswordRequest,
 
 
 @router.put('/update')
-async def update_user_details(data: UpdateUserDetails, current_user: Users = Depends(OAuth2.get_current_user)) -> dict:
-    update_user(user=current_user, data=data)
+async def update_user_details(data: UpdateUserDetails, current_user: Users = Depends(OAuth2.get_current_user),
+                              session: AsyncSession = Depends(get_async_db)) -> dict:
+    await update_user_async(session=session, user=current_user, data=data)
     return response.success(
         status_code=status.HTTP_200_OK,
         message='User details updated successfully',
         data=None,
         warning=None
     )
+
+
+@jwks_router.get('/.well-known/jwks.json', summary='Public keys that verify access tokens')
+async def jwks(if_none_match: Optional[str] = Header(default=None)) -> Response:
+    key_store = jwt_token.key_store
+    if key_store is None:
+        return Response(content=b'{"keys":[]}', media_type="application/json")
+    key_store.refresh()
+    headers = {"Cache-Control": f"public, max-age={variables.JWKS_CACHE_SECONDS}", "ETag": key_store.etag}
+    if if_none_match == key_store.etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=key_store.jwks_body, media_type="application/json", headers=headers)
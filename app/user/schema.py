@@ -3,7 +3,6 @@ from typing import Optional
 
 from pydantic import BaseModel, EmailStr, field_validator
 
-from app.user.queries import get_user_by_phone_or_404, check_existing_user
 from utils import exceptions
 
 
@@ -40,12 +39,6 @@ class UserRegister(BaseModel):
                 message='Phone must be at least 10 characters long',
                 status_code=400
             )
-        phone = get_user_by_phone_or_404(phone=value)
-        return value
-
-    @field_validator('email')
-    def validate_email(cls, value):
-        check_existing_user(value)
         return value
 
     class Config:
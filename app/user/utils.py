@@ -1,13 +1,14 @@
 from pydantic import EmailStr
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.user.queries import verify_user
+from app.user.queries import verify_user_async
 from utils.otp import otp
 
 
-def verify_signup_otp(code: str, email: EmailStr) -> None:
-    otp.verify_otp(user_email=email, otp=code)
-    verify_user(email=email)
+async def verify_signup_otp(session: AsyncSession, code: str, email: EmailStr) -> None:
+    await otp.verify_otp(user_email=email, otp=code)
+    await verify_user_async(session=session, email=email)
 
 
-def verify_forget_password_otp(code: str, email: EmailStr) -> bool:
-    otp.verify_otp(user_email=email, otp=code)
+async def verify_forget_password_otp(code: str, email: EmailStr) -> bool:
+    return await otp.verify_otp(user_email=email, otp=code)
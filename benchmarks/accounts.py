@@ -0,0 +1,249 @@
+"""Load test for the accounts API against local stand-ins.
+
+Boots `main.server` in process on top of SQLite (or any database given
+with --database-url/--async-database-url), fakeredis, a dummy Loki sink
+and benchmarks.standins for the modules missing from this tree, then
+drives signup, login, me and token refresh at a fixed concurrency.
+Latency percentiles and RPS per endpoint are written as JSON and
+compared against a stored baseline.
+
+    pip install -r requirements.txt -r benchmarks/requirements.txt
+    python -m benchmarks.accounts --users 200 --concurrency 16 --output bench.json
+    python -m benchmarks.accounts --baseline benchmarks/baseline.json
+    python -m benchmarks.accounts --baseline benchmarks/baseline.json --update-baseline
+
+benchmarks/baseline.json holds the default run on the reference machine,
+a change that moves it commits the updated file so the diff shows how.
+
+The exit code is 1 when any endpoint regressed by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+SIGNUP = "/accounts/signup"
+LOGIN = "/accounts/login"
+ME = "/accounts/me"
+REFRESH = "/accounts/access/token/new"
+
+# Lower is better for latencies, higher is better for throughput.
+LATENCY_METRICS = ("p50", "p95", "p99")
+THROUGHPUT_METRICS = ("rps",)
+
+
+def configure_environment(database_url: str, async_database_url: str) -> None:
+    """Settings utils.variables reads at import time, so this must run before the app is imported."""
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["ASYNC_DATABASE_URL"] = async_database_url
+    os.environ.setdefault("ENV", "bench")
+    os.environ.setdefault("ALGORITHM", "HS256")
+    os.environ.setdefault("JWT_SECRET_KEY", "bench-secret")
+    os.environ.setdefault("JWT_REFRESH_SECRET_KEY", "bench-refresh-secret")
+    os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+    os.environ.setdefault("REFRESH_TOKEN_EXPIRE_MINUTES", "10080")
+    os.environ.setdefault("MAIL_PORT", "587")
+    os.environ.setdefault("REDIS_SERVER", "redis://localhost:6379/0")
+    os.environ.setdefault("LOKI_URL", "http://loki.bench/loki/api/v1/push")
+    os.environ.setdefault("OTP_RATE_LIMIT", "1000")
+    # Every simulated user logs in from the same address.
+    os.environ.setdefault("LOGIN_IP_LIMIT", "1000000")
+    # A fixed hash cost keeps runs on different machines comparable.
+    os.environ.setdefault("PASSWORD_HASH_CALIBRATE", "false")
+
+
+def percentile(samples: list, fraction: float) -> float:
+    """Nearest rank percentile of already sorted samples."""
+    if not samples:
+        return 0.0
+    index = max(int(round(fraction * len(samples) + 0.5)) - 1, 0)
+    return samples[min(index, len(samples) - 1)]
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        "p50": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+async def run_phase(client, concurrency: int, requests: list) -> dict:
+    """Send `requests` ((method, path, kwargs) tuples) with `concurrency` workers, timing each one."""
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    latencies, responses, errors = [], [], 0
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            method, path, kwargs = queue.get_nowait()
+            start = time.perf_counter()
+            response = await client.request(method, path, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+            responses.append(response)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {"stats": summarize(latencies, errors, time.perf_counter() - start), "responses": responses}
+
+
+async def run(users: int, concurrency: int, me_repeats: int) -> dict:
+    import fakeredis
+    import httpx
+
+    from benchmarks import standins
+    from utils import redis_client
+
+    standins.install()
+
+    # Swap the stand-ins in before the modules holding a reference to them are imported.
+    fake_redis = fakeredis.FakeAsyncRedis()
+    redis_client.client = redis_client.admission_client = fake_redis
+
+    from main import server
+    from utils import log, store
+    from utils.database import Base
+
+    loki_pushes = {"requests": 0, "bytes": 0}
+
+    def loki_sink(request):
+        loki_pushes["requests"] += 1
+        loki_pushes["bytes"] += len(request.content)
+        return httpx.Response(204)
+
+    for handler in log.logger._async_handlers:
+        handler.transport = httpx.MockTransport(loki_sink)
+
+    await server.router.startup()
+    Base.metadata.create_all(store.engine)
+
+    results = {}
+    transport = httpx.ASGITransport(app=server)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        accounts = [
+            {
+                "email": f"bench{index}@example.com",
+                "full_name": f"Bench User {index}",
+                "phone": f"98{index:08d}",
+                "address": "Kathmandu",
+                "password": "strongpassword123",
+                "confirm_password": "strongpassword123",
+            }
+            for index in range(users)
+        ]
+
+        phase = await run_phase(client, concurrency, [("POST", SIGNUP, {"json": account}) for account in accounts])
+        results[SIGNUP] = phase["stats"]
+
+        # Activation is setup, not a measured endpoint.
+        for account in accounts:
+            code = await fake_redis.get(f"otp:{account['email']}")
+            await client.post("/accounts/verify/otp/", json={"email": account["email"], "otp": code.decode()})
+
+        phase = await run_phase(client, concurrency, [
+            ("POST", LOGIN, {"json": {"email": account["email"], "password": account["password"]}})
+            for account in accounts
+        ])
+        results[LOGIN] = phase["stats"]
+        tokens = [response.json()["data"] for response in phase["responses"] if response.status_code == 200]
+
+        phase = await run_phase(client, concurrency, [
+            ("GET", ME, {"headers": {"Authorization": f"Bearer {token['access_token']}"}})
+            for token in tokens for _ in range(me_repeats)
+        ])
+        results[ME] = phase["stats"]
+
+        phase = await run_phase(client, concurrency, [
+            ("POST", REFRESH, {"json": {"refresh_token": token["refresh_token"]}})
+            for token in tokens
+        ])
+        results[REFRESH] = phase["stats"]
+
+    await server.router.shutdown()
+    return {"endpoints": results, "loki": loki_pushes}
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """Return human readable regressions of `current` against `baseline`."""
+    regressions = []
+    for endpoint, stats in current["endpoints"].items():
+        expected = baseline.get("endpoints", {}).get(endpoint)
+        if not expected:
+            continue
+        for metric in LATENCY_METRICS:
+            if expected[metric] and stats[metric] > expected[metric] * (1 + tolerance):
+                regressions.append(f"{endpoint} {metric} {expected[metric]}ms -> {stats[metric]}ms")
+        for metric in THROUGHPUT_METRICS:
+            if expected[metric] and stats[metric] < expected[metric] * (1 - tolerance):
+                regressions.append(f"{endpoint} {metric} {expected[metric]} -> {stats[metric]}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--me-repeats", type=int, default=5, help="/accounts/me calls per logged in user")
+    parser.add_argument("--database-url", help="sync SQLAlchemy url, defaults to a throwaway SQLite file")
+    parser.add_argument("--async-database-url", help="async SQLAlchemy url matching --database-url")
+    parser.add_argument("--output", help="write the results JSON here as well as to stdout")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="overwrite --baseline with this run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown, 0.2 = 20%%")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="accounts-bench-")
+    sqlite_path = os.path.join(workdir, "bench.db")
+    configure_environment(
+        args.database_url or f"sqlite:///{sqlite_path}",
+        args.async_database_url or f"sqlite+aiosqlite:///{sqlite_path}",
+    )
+
+    results = asyncio.run(run(args.users, args.concurrency, args.me_repeats))
+    results["meta"] = {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "me_repeats": args.me_repeats,
+        "python": platform.python_version(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+    rendered = json.dumps(results, indent=2, sort_keys=True)
+    print(rendered)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(rendered + "\n")
+
+    if not args.baseline:
+        return 0
+    if args.update_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            baseline_file.write(rendered + "\n")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run again with --update-baseline to record one.", file=sys.stderr)
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
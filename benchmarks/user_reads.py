@@ -0,0 +1,111 @@
+"""Micro-benchmark of the hot user reads, ORM hydration against app.user.reads.
+
+Runs each lookup --iterations times against a throwaway SQLite file (or
+--async-database-url) holding --users users, and prints the mean time per
+call in microseconds as JSON. Both sides pay the same database round
+trip and run the same query, the difference is statement construction,
+compilation and row hydration.
+
+    python -m benchmarks.user_reads --users 1000 --iterations 5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.accounts import configure_environment
+
+
+async def measure(iterations: int, call, emails: list) -> float:
+    start = time.perf_counter()
+    for index in range(iterations):
+        await call(emails[index % len(emails)])
+    return round((time.perf_counter() - start) / iterations * 1_000_000, 2)
+
+
+async def run(async_database_url: str, users: int, iterations: int) -> dict:
+    from sqlalchemy import false, func, insert, select
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    from app.user import reads
+    from app.user.models import Users
+    from app.user.schema import UserDetails, UserRegisterResponse
+
+    engine = create_async_engine(async_database_url)
+    async with engine.begin() as connection:
+        await connection.run_sync(Users.__table__.create, checkfirst=True)
+        await connection.execute(insert(Users), [
+            {
+                "email": f"read{index}@example.com",
+                "full_name": f"Read User {index}",
+                "phone": f"97{index:08d}",
+                "address": "Kathmandu",
+                "password": "$2b$12$" + "x" * 53,
+                "is_active": True,
+            }
+            for index in range(users)
+        ])
+    emails = [f"read{index}@example.com" for index in range(users)]
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+
+    async with sessions() as session:
+        # The same predicates as the projected statements, only the statement and row handling differ.
+        def orm_user(email):
+            return select(Users).where(
+                func.lower(Users.email) == func.lower(email), Users.is_deleted == false()
+            ).limit(1)
+
+        async def orm_login(email):
+            result = await session.execute(orm_user(email))
+            UserRegisterResponse.from_orm(result.scalars().first())
+            session.expunge_all()
+
+        async def orm_principal(email):
+            result = await session.execute(orm_user(email))
+            UserDetails.from_orm(result.scalars().first())
+            session.expunge_all()
+
+        async def projected_login(email):
+            UserRegisterResponse.from_orm(await reads.get_login_user_async(session, email))
+
+        async def projected_principal(email):
+            UserDetails.from_orm(await reads.get_principal_async(session, email))
+
+        # Warm up the statement caches of both sides.
+        for call in (orm_login, orm_principal, projected_login, projected_principal):
+            await measure(10, call, emails)
+
+        results = {}
+        for name, orm, projected in (
+            ("login", orm_login, projected_login),
+            ("principal", orm_principal, projected_principal),
+        ):
+            before = await measure(iterations, orm, emails)
+            after = await measure(iterations, projected, emails)
+            results[name] = {"orm_us": before, "projected_us": after, "speedup": round(before / after, 2)}
+
+    await engine.dispose()
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--async-database-url", help="async SQLAlchemy url, defaults to a throwaway SQLite file")
+    args = parser.parse_args(argv)
+
+    sqlite_path = os.path.join(tempfile.mkdtemp(prefix="user-reads-bench-"), "reads.db")
+    url = args.async_database_url or f"sqlite+aiosqlite:///{sqlite_path}"
+    configure_environment(f"sqlite:///{sqlite_path}", url)
+    results = asyncio.run(run(url, args.users, args.iterations))
+    json.dump({"users": args.users, "iterations": args.iterations, "reads": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,4 +6,5 @@ echo "Starting authentication service"
 alembic upgrade head
 
 # Start the application with the appropriate port
-uvicorn main:server --host 0.0.0.0 --port 5000
+# Trust X-Forwarded-For from FORWARDED_ALLOW_IPS so the client address is the real client's
+uvicorn main:server --host 0.0.0.0 --port 5000 --proxy-headers --forwarded-allow-ips "${FORWARDED_ALLOW_IPS:-127.0.0.1}"
@@ -4,18 +4,23 @@ from fastapi.exceptions import (HTTPException, RequestValidationError)
 from fastapi.middleware.cors import CORSMiddleware
 from jose.exceptions import JWTError
 from sqlalchemy.exc import OperationalError, PendingRollbackError
-from starlette.middleware.base import BaseHTTPMiddleware
 
-from app.user.routers import router as user_router
-from utils import response, constant, exceptions, middleware, helpers
-from utils.database import connect_to_database, disconnect_from_database, rollback_session
+from app.internal.routers import router as internal_router, metrics_router
+from app.user.routers import router as user_router, jwks_router
+from utils import (response, constant, exceptions, middleware, helpers, idempotency, jwt_token, log, redis_client,
+                   variables, watchdog)
+from utils.database import (connect_to_async_database, connect_to_database, disconnect_from_async_database,
+                            disconnect_from_database, rollback_session, start_replica_health_checks)
 
 
 def register_routes(server):
     server.include_router(user_router)
+    server.include_router(jwks_router)
     server.include_router(payment_router)
     server.include_router(order_router)
     server.include_router(search_router)
+    server.include_router(internal_router)
+    server.include_router(metrics_router)
 
 
 def register_middlewares(server):
@@ -39,13 +44,24 @@ server = FastAPI(
 # Startup Events
 @server.on_event("startup")
 async def startup_event():
+    await log.logger.start()
+    await jwt_token.calibrate_password_hashing()
     connect_to_database()
+    connect_to_async_database()
+    start_replica_health_checks()
+    if variables.WATCHDOG_ENABLED:
+        await watchdog.watchdog.start()
 
 
 # Shutdown Events
 @server.on_event("shutdown")
 async def shutdown_event():
+    await watchdog.watchdog.stop()
     disconnect_from_database()
+    await disconnect_from_async_database()
+    jwt_token.hashing_pool.shutdown()
+    await redis_client.close()
+    await log.logger.aclose()
 
 
 # Register Routes
@@ -54,8 +70,20 @@ register_routes(server)
 # Register Middlewares
 register_middlewares(server)
 
+# Idempotency-Key handling, inside the logging middleware so replays are logged too
+server.add_middleware(
+    idempotency.IdempotencyMiddleware,
+    client=redis_client.client,
+    paths=variables.IDEMPOTENCY_PATHS,
+    ttl=variables.IDEMPOTENCY_TTL,
+    lock_ttl=variables.IDEMPOTENCY_LOCK_TTL,
+    wait_timeout=variables.IDEMPOTENCY_WAIT_TIMEOUT,
+    poll_interval=variables.IDEMPOTENCY_POLL_INTERVAL_MS / 1000,
+    max_body_size=variables.IDEMPOTENCY_MAX_BODY_BYTES,
+)
+
 # add logging middleware
-server.add_middleware(BaseHTTPMiddleware, dispatch=middleware.optimized_logging_middleware)
+server.add_middleware(middleware.LoggingMiddleware)
 
 
 # add custom exception handler.
@@ -87,40 +115,37 @@ async def database_connection_exception_handler(_, exception):
 
 @server.exception_handler(exceptions.GenericError)
 async def generic_exception_handler(_, exception):
-    return response.error(message=exception.message, status_code=exception.status_code)
+    error_response = response.error(message=exception.message, status_code=exception.status_code)
+    if exception.headers:
+        error_response.headers.update(exception.headers)
+    return error_response
 
 
 @server.exception_handler(exceptions.InternalError)
 async def internal_exception_handler(_, exception):
-    rollback_session()
     return response.error(exception.status_code, exception.message)
 
 
 @server.exception_handler(HTTPException)
 async def http_exception_handler(_, exception):
-    rollback_session()
     return response.error(exception.status_code, exception.detail)
 
 
 @server.exception_handler(Exception)
 async def exception_handler(_, exception):
-    rollback_session()
     return response.error(constant.ERROR_INTERNAL_SERVER_ERROR, str(exception))
 
 
 @server.exception_handler(JWTError)
 async def jwt_exception_handler(_, exception):
-    rollback_session()
     return response.error(constant.UNPROCESSABLE_ENTITY, str(exception))
 
 
 @server.exception_handler(exceptions.ValidationError)
 async def validation_exception_handler(_, exception):
-    rollback_session()
     return response.error(constant.ERROR_BAD_REQUEST, str(exception.message))
 
 
 @server.exception_handler(json.JSONDecodeError)
 async def json_exception_handler(_, exception):
-    rollback_session()
     return response.error(constant.UNPROCESSABLE_ENTITY, str(exception))
@@ -0,0 +1,50 @@
+import fakeredis
+import pytest
+from redis.exceptions import TimeoutError
+
+from utils import metrics
+from utils.admission import AdmissionController
+from utils.exceptions import GenericError
+
+
+def shed(scope, backend):
+    prefix = f'admission_shed_total{{scope="{scope}",backend="{backend}"}} '
+    lines = [line for line in metrics.registry.render().decode().splitlines() if line.startswith(prefix)]
+    return float(lines[0][len(prefix):]) if lines else 0.0
+
+
+def controller(client, **kwargs):
+    return AdmissionController(client, limits={"email": (2, 60), "ip": (3, 60)}, **kwargs)
+
+
+async def test_attempts_over_either_window_are_refused_before_hashing():
+    admission = controller(fakeredis.FakeAsyncRedis())
+    before = shed("email", "redis")
+
+    await admission.admit(email="a@b.co", ip="10.0.0.1")
+    await admission.admit(email="a@b.co", ip="10.0.0.1")
+    with pytest.raises(GenericError) as error:
+        await admission.admit(email="a@b.co", ip="10.0.0.1")
+    assert error.value.status_code == 429
+    assert 1 <= int(error.value.headers["Retry-After"]) <= 60
+    assert shed("email", "redis") == before + 1
+
+    # The refused attempt was not counted against the ip.
+    await admission.admit(email="c@b.co", ip="10.0.0.1")
+    with pytest.raises(GenericError):
+        await admission.admit(email="d@b.co", ip="10.0.0.1")
+
+
+async def test_slow_redis_falls_back_to_local_buckets():
+    class SlowRedis(fakeredis.FakeAsyncRedis):
+        async def evalsha(self, *args, **kwargs):
+            raise TimeoutError("Timeout reading from socket")
+
+    admission = controller(SlowRedis())
+
+    await admission.admit(email="a@b.co", ip="10.0.0.1")
+    await admission.admit(email="a@b.co", ip="10.0.0.1")
+    with pytest.raises(GenericError) as error:
+        await admission.admit(email="a@b.co", ip="10.0.0.1")
+    assert error.value.status_code == 429
+    assert shed("email", "local") >= 1
@@ -0,0 +1,38 @@
+from utils import cache
+from utils.cache import TTLCache
+
+
+def test_evicts_least_recently_used():
+    lru = TTLCache(maxsize=2, ttl=60)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+    assert lru.get("b") is None
+    assert lru.get("a") == 1
+    assert lru.get("c") == 3
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    ttl_cache = TTLCache(maxsize=10, ttl=30)
+    ttl_cache.set("token", "payload", ttl=5)
+    ttl_cache.set("user", "principal", ttl=3600)
+    now[0] += 10
+    assert ttl_cache.get("token") is None
+    assert ttl_cache.get("user") == "principal"
+    now[0] += 30
+    assert ttl_cache.get("user") is None
+
+
+def test_non_positive_ttl_is_not_cached():
+    ttl_cache = TTLCache(maxsize=10, ttl=30)
+    ttl_cache.set("expired", "payload", ttl=-1)
+    assert len(ttl_cache) == 0
+
+
+def test_invalidate_principal():
+    cache.principal_cache.set("test@example.com", {"id": 1})
+    cache.invalidate_principal("test@example.com")
+    assert cache.principal_cache.get("test@example.com") is None
@@ -0,0 +1,88 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from utils import database
+from utils.database import RequestDatabaseStats, RequestSession, db_stats_var, instrument_engine, normalize_sql
+
+
+def test_connection_hold_time_is_added_to_request_stats(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'hold.db'}")
+    stats = RequestDatabaseStats()
+    token = db_stats_var.set(stats)
+    try:
+        session = RequestSession(bind=engine)
+        session.execute(text("SELECT 1"))
+        session.commit()
+        session.execute(text("SELECT 1"))
+        session.close()
+    finally:
+        db_stats_var.reset(token)
+
+    assert stats.transactions == 2
+    assert stats.connection_hold_time > 0
+
+
+def test_session_without_statements_holds_nothing(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'idle.db'}")
+    stats = RequestDatabaseStats()
+    token = db_stats_var.set(stats)
+    try:
+        session = RequestSession(bind=engine)
+        assert not session.in_transaction()
+        session.close()
+    finally:
+        db_stats_var.reset(token)
+
+    assert stats.transactions == 0
+    assert engine.pool.checkedout() == 0
+
+
+def test_statements_are_counted_and_slow_ones_logged(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'slow.db'}")
+    instrument_engine(engine)
+    monkeypatch.setattr(database, "DB_SLOW_QUERY_MS", 0)
+    slow_logs = []
+    monkeypatch.setattr(database.logger, "warning", lambda message: slow_logs.append(str(message)))
+
+    stats = RequestDatabaseStats()
+    token = db_stats_var.set(stats)
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1 WHERE 'a' = 'a'"))
+            connection.execute(text("SELECT 2"))
+    finally:
+        db_stats_var.reset(token)
+
+    assert stats.statements == 2
+    assert stats.time >= stats.slowest_time > 0
+    assert len(slow_logs) == 2
+    assert '"statement": "SELECT ? WHERE ? = ?"' in slow_logs[0]
+    assert "test/database_test.py" in slow_logs[0]
+
+
+def test_statements_after_a_failure_are_timed_from_their_own_start(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'failed.db'}")
+    instrument_engine(engine)
+    stats = RequestDatabaseStats()
+    token = db_stats_var.set(stats)
+    try:
+        with engine.connect() as connection:
+            for _ in range(3):
+                with pytest.raises(OperationalError):
+                    connection.execute(text("SELECT * FROM missing"))
+            time.sleep(0.05)
+            connection.execute(text("SELECT 1"))
+    finally:
+        db_stats_var.reset(token)
+
+    assert stats.statements == 1
+    assert stats.slowest_time < 0.05
+
+
+def test_normalize_sql():
+    assert normalize_sql("SELECT *\n  FROM \"Users\"\n WHERE id = 42 AND email = 'a''b'") == (
+        'SELECT * FROM "Users" WHERE id = ? AND email = ?'
+    )
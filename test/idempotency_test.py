@@ -0,0 +1,72 @@
+import asyncio
+
+import fakeredis
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from utils.idempotency import IdempotencyMiddleware
+
+
+def make_client(status_codes=None, delay=0.0):
+    calls = []
+
+    async def signup(request: Request):
+        calls.append(await request.json())
+        await asyncio.sleep(delay)
+        status_code = status_codes.pop(0) if status_codes else 201
+        return JSONResponse({"call": len(calls)}, status_code=status_code)
+
+    app = Starlette(routes=[Route("/signup", signup, methods=["POST"])])
+    app.add_middleware(IdempotencyMiddleware, client=fakeredis.FakeAsyncRedis(), paths=["/signup"],
+                       poll_interval=0.01)
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+    return client, calls
+
+
+async def test_repeated_key_replays_the_first_response():
+    client, calls = make_client()
+    headers = {"Idempotency-Key": "key-1"}
+
+    first = await client.post("/signup", json={"email": "a@b.co"}, headers=headers)
+    second = await client.post("/signup", json={"email": "a@b.co"}, headers=headers)
+    other_body = await client.post("/signup", json={"email": "x@b.co"}, headers=headers)
+    without_key = await client.post("/signup", json={"email": "a@b.co"})
+
+    assert first.status_code == second.status_code == 201
+    assert second.json() == first.json() == {"call": 1}
+    assert "idempotency-replayed" not in first.headers
+    assert second.headers["idempotency-replayed"] == "true"
+    assert second.headers["content-type"] == "application/json"
+    assert other_body.status_code == 422
+    assert without_key.json() == {"call": 2}
+    assert len(calls) == 2
+
+
+async def test_concurrent_duplicates_wait_for_the_first_request():
+    client, calls = make_client(delay=0.05)
+    headers = {"Idempotency-Key": "key-2"}
+
+    responses = await asyncio.gather(*(
+        client.post("/signup", json={"email": "a@b.co"}, headers=headers) for _ in range(3)
+    ))
+
+    assert len(calls) == 1
+    assert [response.json() for response in responses] == [{"call": 1}] * 3
+    assert sum("idempotency-replayed" in response.headers for response in responses) == 2
+
+
+@pytest.mark.parametrize("status_code", [500, 429])
+async def test_server_errors_and_retry_later_are_not_stored(status_code):
+    client, calls = make_client(status_codes=[status_code])
+    headers = {"Idempotency-Key": "key-3"}
+
+    assert (await client.post("/signup", json={}, headers=headers)).status_code == status_code
+    retried = await client.post("/signup", json={}, headers=headers)
+
+    assert retried.status_code == 201
+    assert "idempotency-replayed" not in retried.headers
+    assert len(calls) == 2
@@ -0,0 +1,27 @@
+from fastapi import FastAPI
+from starlette.testclient import TestClient
+
+from app.internal.routers import router
+from utils import exceptions, helpers, response
+
+
+def make_client():
+    app = FastAPI()
+    app.include_router(router)
+
+    @app.exception_handler(exceptions.GenericError)
+    async def generic_exception_handler(_, exception):
+        return response.error(message=exception.message, status_code=exception.status_code)
+
+    return TestClient(app)
+
+
+def test_every_internal_endpoint_requires_the_internal_token(monkeypatch):
+    monkeypatch.setattr(helpers, "INTERNAL_API_TOKEN", "secret")
+    client = make_client()
+
+    for path in ("/internal/db/pool", "/internal/hashing", "/internal/watchdog", "/internal/profile/memory/diff"):
+        assert client.get(path).status_code == 403
+        assert client.get(path, headers={"X-Internal-Token": "wrong"}).status_code == 403
+    for path in ("/internal/hashing", "/internal/watchdog"):
+        assert client.get(path, headers={"X-Internal-Token": "secret"}).status_code == 200
@@ -0,0 +1,71 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.internal import queries
+from app.internal.queries import introspect_tokens_async
+from app.user.models import Users
+from utils import cache, jwt_token
+from utils.jwks import UnknownKeyError
+
+
+@pytest.fixture
+async def session(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'introspect.db'}")
+    async with engine.begin() as connection:
+        await connection.run_sync(Users.__table__.create)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessions() as session:
+        session.add(Users(email="a@b.co", full_name="A", phone="9800000000", address="Kathmandu", password="x"))
+        await session.commit()
+
+        statements = []
+        event.listen(engine.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        session.info["statements"] = statements
+        cache.introspection_cache.clear()
+        yield session
+    cache.introspection_cache.clear()
+    await engine.dispose()
+
+
+async def test_batch_is_resolved_with_one_query_and_answered_in_order(session):
+    known = jwt_token.create_access_token("a@b.co")
+    unknown = jwt_token.create_access_token("ghost@b.co")
+
+    results = await introspect_tokens_async(session, [known, "garbage", unknown, known])
+
+    assert [result.active for result in results] == [True, False, False, True]
+    assert results[0].sub == "a@b.co" and results[0].exp > 0
+    assert results[0] == results[3]
+    [query] = session.info["statements"]
+    assert " IN " in query
+
+
+async def test_repeated_introspection_is_served_from_the_cache(session):
+    known = jwt_token.create_access_token("a@b.co")
+    await introspect_tokens_async(session, [known, "garbage"])
+    session.info["statements"].clear()
+
+    results = await introspect_tokens_async(session, ["garbage", known])
+
+    assert [result.active for result in results] == [False, True]
+    assert session.info["statements"] == []
+
+
+async def test_unknown_key_ids_are_not_memoized_for_long(session, monkeypatch):
+    token = jwt_token.create_access_token("a@b.co")
+    decode = jwt_token.decode_access_token
+
+    def not_loaded_yet(encoded):
+        if encoded == token:
+            raise UnknownKeyError("Unknown key id 'next'")
+        return decode(encoded)
+
+    monkeypatch.setattr(jwt_token, "decode_access_token", not_loaded_yet)
+    monkeypatch.setattr(queries, "PRINCIPAL_CACHE_TTL", 0)
+    assert [result.active for result in await introspect_tokens_async(session, [token, "garbage"])] == [False, False]
+
+    # Once the key is loaded the token is active, while the malformed one stays memoized.
+    monkeypatch.setattr(jwt_token, "decode_access_token", decode)
+    assert cache.introspection_cache.get(cache.token_digest("garbage")) is not None
+    assert [result.active for result in await introspect_tokens_async(session, [token])] == [True]
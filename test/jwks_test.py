@@ -0,0 +1,57 @@
+import os
+
+import pytest
+from jose import jwt
+
+from utils.jwks import KeyStore, TokenVerifier, generate
+
+
+def sign(key_store, claims):
+    kid, key = key_store.signing_key()
+    return jwt.encode(claims, key, "ES256", headers={"kid": kid})
+
+
+def test_jwks_publishes_public_keys_only(tmp_path):
+    generate(str(tmp_path), "2026-01")
+    key_store = KeyStore(str(tmp_path))
+
+    [published] = key_store.jwks()["keys"]
+    assert published["kid"] == "2026-01"
+    assert (published["kty"], published["crv"], published["alg"]) == ("EC", "P-256", "ES256")
+    assert "d" not in published
+    assert oct(os.stat(tmp_path / "2026-01.pem").st_mode)[-3:] == "600"
+
+
+def test_rotation_signs_with_the_newest_key_and_keeps_old_tokens_valid(tmp_path):
+    generate(str(tmp_path), "2026-01")
+    key_store = KeyStore(str(tmp_path), refresh_interval=0)
+    verifier = TokenVerifier(key_store.jwks, min_refresh_interval=0)
+    old_token = sign(key_store, {"sub": "a@b.co"})
+
+    generate(str(tmp_path), "2026-02")
+    new_token = sign(key_store, {"sub": "a@b.co"})
+
+    assert jwt.get_unverified_header(new_token)["kid"] == "2026-02"
+    assert verifier.decode(old_token)["sub"] == "a@b.co"
+    assert verifier.decode(new_token)["sub"] == "a@b.co"
+    assert set(verifier.keys) == {"2026-01", "2026-02"}
+
+
+def test_unknown_kid_refetches_at_most_once_per_interval(tmp_path):
+    generate(str(tmp_path), "2026-01")
+    key_store = KeyStore(str(tmp_path))
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return key_store.jwks()
+
+    verifier = TokenVerifier(fetch, min_refresh_interval=60)
+    token = sign(key_store, {"sub": "a@b.co"})
+    assert verifier.decode(token)["sub"] == "a@b.co"
+    assert verifier.decode(token)["sub"] == "a@b.co"
+
+    forged = jwt.encode({"sub": "a@b.co"}, "secret", "HS256", headers={"kid": "missing"})
+    with pytest.raises(jwt.JWTError):
+        verifier.decode(forged)
+    assert len(fetches) == 1
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from utils import exceptions, jwt_token
+
+
+@pytest.fixture(scope="module")
+def hashed_password():
+    return jwt_token.get_hashed_password("strongpassword123")
+
+
+async def test_verify_password_async(hashed_password):
+    await jwt_token.verify_password_async("strongpassword123", hashed_password)
+    with pytest.raises(exceptions.GenericError) as error:
+        await jwt_token.verify_password_async("wrongpassword", hashed_password)
+    assert error.value.status_code == 401
+
+
+async def test_password_change_reports_wrong_current_password_first(hashed_password):
+    with pytest.raises(exceptions.GenericError) as error:
+        await jwt_token.verify_password_change_async("wrongpassword", "strongpassword123", hashed_password)
+    assert error.value.status_code == 401
+
+    with pytest.raises(exceptions.GenericError) as error:
+        await jwt_token.verify_password_change_async("strongpassword123", "strongpassword123", hashed_password)
+    assert error.value.status_code == 400
+
+
+def test_bcrypt_calibration_stays_within_policy():
+    assert jwt_token.calibrate_bcrypt(budget=0, min_rounds=4, max_rounds=6) == {"scheme": "bcrypt", "rounds": 4}
+    assert jwt_token.calibrate_bcrypt(budget=3600, min_rounds=4, max_rounds=6)["rounds"] == 6
+
+
+async def test_login_rehashes_only_out_of_policy_hashes():
+    original = jwt_token.password_settings
+    jwt_token.configure_password_context({"scheme": "bcrypt", "rounds": 4})
+    try:
+        cheap_hash = jwt_token.get_hashed_password("strongpassword123")
+        jwt_token.configure_password_context({"scheme": "bcrypt", "rounds": 5})
+
+        new_hash = await jwt_token.verify_password_and_rehash_async("strongpassword123", cheap_hash)
+        assert new_hash.startswith("$2b$05$")
+        assert await jwt_token.verify_password_and_rehash_async("strongpassword123", new_hash) is None
+        with pytest.raises(exceptions.GenericError):
+            await jwt_token.verify_password_and_rehash_async("wrongpassword", cheap_hash)
+    finally:
+        jwt_token.configure_password_context(original)
+
+
+async def test_hashing_pool_caps_concurrency():
+    pool = jwt_token.HashingPool(workers=1, max_concurrency=1)
+
+    def slow(value):
+        return value
+
+    first = asyncio.create_task(pool.run(slow, 1))
+    second = asyncio.create_task(pool.run(slow, 2))
+    await asyncio.sleep(0)
+    assert pool.stats()["queue_depth"] == 1
+    assert await asyncio.gather(first, second) == [1, 2]
+    assert pool.queue_depth == 0
+    pool.shutdown()
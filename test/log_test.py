@@ -0,0 +1,108 @@
+import asyncio
+import gzip
+import json
+import logging
+
+import httpx
+
+from utils.log import LOG_FORMAT, AsyncLokiHandler, CustomFormatter, LogSampler, StructuredMessage
+
+
+def make_record(message, level=logging.INFO):
+    return logging.LogRecord("test", level, __file__, 1, message, None, None)
+
+
+def make_handler(handler_fn, **kwargs):
+    handler = AsyncLokiHandler(
+        url="http://loki.test/loki/api/v1/push",
+        labels={"service": "login-auth"},
+        transport=httpx.MockTransport(handler_fn),
+        **kwargs
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    return handler
+
+
+async def test_flush_pushes_one_gzipped_payload_grouped_by_labels():
+    pushes = []
+
+    def loki(request):
+        assert request.headers["Content-Encoding"] == "gzip"
+        pushes.append(json.loads(gzip.decompress(request.content)))
+        return httpx.Response(204)
+
+    handler = make_handler(loki)
+    handler.emit(make_record("first"))
+    handler.emit(make_record("second"))
+    handler.emit(make_record("broken", logging.ERROR))
+    await handler.start()
+    await handler.aclose()
+
+    assert len(pushes) == 1
+    streams = {stream["stream"]["level"]: stream for stream in pushes[0]["streams"]}
+    assert [value[1] for value in streams["info"]["values"]] == ["first", "second"]
+    assert [value[1] for value in streams["error"]["values"]] == ["broken"]
+    assert streams["info"]["stream"]["service"] == "login-auth"
+    assert handler.stats() == {"queue_depth": 0, "dropped": 0, "sent": 3}
+
+
+def test_full_buffer_drops_oldest_records():
+    handler = make_handler(lambda request: httpx.Response(204), max_queue_size=2)
+    for message in ("one", "two", "three"):
+        handler.emit(make_record(message))
+
+    assert [entry[2] for entry in handler.buffer] == ["two", "three"]
+    assert handler.dropped == 1
+
+
+async def test_failed_batch_is_requeued():
+    handler = make_handler(lambda request: httpx.Response(500))
+    handler.emit(make_record("kept"))
+    await handler.start()
+    await handler.aclose()
+
+    assert [entry[2] for entry in handler.buffer] == ["kept"]
+    assert handler.sent == 0
+
+
+async def test_batch_in_flight_at_shutdown_is_sent_by_close():
+    attempts = []
+    in_flight = asyncio.Event()
+
+    async def loki(request):
+        attempts.append(json.loads(gzip.decompress(request.content)))
+        if len(attempts) == 1:
+            in_flight.set()
+            await asyncio.sleep(10)
+        return httpx.Response(204)
+
+    handler = make_handler(loki, batch_size=1)
+    await handler.start()
+    handler.emit(make_record("in flight"))
+    await in_flight.wait()
+    await handler.aclose()
+
+    assert len(attempts) == 2
+    assert attempts[1]["streams"][0]["values"][0][1] == "in flight"
+    assert handler.stats() == {"queue_depth": 0, "dropped": 0, "sent": 1}
+
+
+def test_structured_message_is_rendered_once_per_record():
+    message = StructuredMessage("Request completed successfully", {"status_code": 200})
+    record = make_record(message)
+    formatter = CustomFormatter(LOG_FORMAT)
+
+    first = formatter.format(record)
+    message.fields["status_code"] = 500  # a second handler must not re-render it
+    assert CustomFormatter(LOG_FORMAT).format(record) is first
+    assert first.endswith('Request completed successfully: {"status_code": 200}')
+
+
+def test_sampler_keeps_errors_and_slow_requests_and_decides_per_trace_id():
+    sampler = LogSampler(rate=0.25, slow_threshold=1.0)
+    assert sampler.keep("any", 404, 0.01)
+    assert sampler.keep("any", 200, 2.0)
+
+    decisions = {f"trace-{index}": sampler.keep(f"trace-{index}", 200, 0.01) for index in range(2000)}
+    assert 0.2 < sum(decisions.values()) / len(decisions) < 0.3
+    assert all(sampler.keep(trace_id, 200, 0.01) == kept for trace_id, kept in decisions.items())
@@ -0,0 +1,78 @@
+import os
+import threading
+
+from utils.metrics import MmapStorage, Registry, read_file
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0))
+    latency.labels("/a").observe(0.05)
+    latency.labels("/a").observe(0.5)
+    latency.labels("/a").observe(5)
+
+    lines = registry.render().decode().splitlines()
+    assert '# TYPE latency_seconds histogram' in lines
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 1.0' in lines
+    assert 'latency_seconds_bucket{route="/a",le="1.0"} 2.0' in lines
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 3.0' in lines
+    assert 'latency_seconds_count{route="/a"} 3.0' in lines
+    assert 'latency_seconds_sum{route="/a"} 5.55' in lines
+
+
+def test_counter_labels_are_escaped():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests.", ("path",))
+    requests.labels('/a"b').inc(2)
+    assert 'requests_total{path="/a\\"b"} 2.0' in registry.render().decode().splitlines()
+
+
+def test_mmap_storage_grows_and_is_readable_from_disk(tmp_path):
+    storage = MmapStorage(str(tmp_path / "1.db"), initial_size=64)
+    slots = [storage.slot(f"key-{index}") for index in range(50)]
+    for index, slot in enumerate(slots):
+        storage.add(slot, index)
+    storage.add(slots[3], 0.5)
+
+    values = dict(read_file(storage.path))
+    assert len(values) == 50
+    assert values["key-3"] == 3.5
+    storage.close()
+
+
+def test_multiprocess_collect_sums_workers_and_skips_dead_gauges(tmp_path):
+    registry = Registry(multiproc_dir=str(tmp_path))
+    hits = registry.counter("hits_total", "Hits.")
+    depth = registry.gauge("depth", "Depth.")
+    hits.inc(2)
+    depth.set(4)
+
+    # A file left behind by a worker that is gone.
+    dead = MmapStorage(os.path.join(str(tmp_path), "999999999.db"))
+    dead.add(dead.slot('["hits_total","hits_total",{}]'), 3)
+    dead.add(dead.slot('["depth","depth",{}]'), 7)
+    dead.close()
+
+    lines = registry.render().decode().splitlines()
+    assert "hits_total 5.0" in lines
+    assert "depth 4.0" in lines
+
+
+def test_mmap_storage_adds_from_threads_while_growing(tmp_path):
+    storage = MmapStorage(str(tmp_path / "2.db"), initial_size=64)
+    counter = storage.slot("counter")
+
+    def add():
+        for _ in range(2000):
+            storage.add(counter, 1)
+
+    threads = [threading.Thread(target=add) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for index in range(500):
+        storage.slot(f"key-{index}")
+    for thread in threads:
+        thread.join()
+
+    assert dict(storage.items())["counter"] == 8000
+    storage.close()
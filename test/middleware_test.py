@@ -0,0 +1,86 @@
+import json
+from unittest import mock
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from utils import middleware
+from utils.middleware import LoggingMiddleware, redact
+
+
+def test_redact_masks_sensitive_values():
+    body = b'{"email": "a@b.co", "password": "se\\"cret", "user": {"refresh_token": "abc"}, "confirm_password": 123}'
+    assert redact(body) == (
+        '{"email": "a@b.co", "password": "******", "user": {"refresh_token": "******"}, '
+        '"confirm_password": "******"}'
+    )
+
+
+def test_redact_masks_truncated_values():
+    assert redact(b'{"email": "a@b.co", "password": "my secret pass') == '{"email": "a@b.co", "password": "******"'
+
+
+def test_redact_leaves_other_bodies_alone():
+    assert redact(b"plain text body") == "plain text body"
+    assert redact(b"") == ""
+
+
+async def echo(request: Request):
+    return JSONResponse(await request.json())
+
+
+def make_client(max_body_size=4096):
+    app = Starlette(routes=[Route("/echo", echo, methods=["POST"])])
+    app.add_middleware(LoggingMiddleware, max_body_size=max_body_size)
+    return TestClient(app)
+
+
+def logged_line(log_call):
+    message = str(log_call.args[0])
+    return json.loads(message[message.index("{"):])
+
+
+def test_logs_after_response_with_redacted_body():
+    with mock.patch.object(middleware, "logger") as logger:
+        response = make_client().post(
+            "/echo", json={"email": "a@b.co", "password": "secret"}, headers={"X-Trace-ID": "trace-1"}
+        )
+
+    assert response.json() == {"email": "a@b.co", "password": "secret"}
+    line = logged_line(logger.info.call_args)
+    assert line["trace_id"] == "trace-1"
+    assert line["status_code"] == 200
+    assert "secret" not in line["request_payload"]
+    assert "request_payload_truncated" not in line
+
+
+def test_body_kept_for_the_log_is_capped():
+    with mock.patch.object(middleware, "logger") as logger:
+        response = make_client(max_body_size=10).post("/echo", json={"email": "a@b.co"})
+
+    assert response.json() == {"email": "a@b.co"}
+    line = logged_line(logger.info.call_args)
+    assert len(line["request_payload"]) == 10
+    assert line["request_payload_truncated"] is True
+
+
+def test_oversized_or_unsafe_trace_id_is_replaced():
+    for trace_id in ("x" * 65, "bad id\"}"):
+        with mock.patch.object(middleware, "logger") as logger:
+            make_client().post("/echo", json={}, headers={"X-Trace-ID": trace_id})
+
+        logged = logged_line(logger.info.call_args)["trace_id"]
+        assert logged != trace_id
+        assert len(logged) == 36
+
+
+def test_sticky_key_is_a_token_digest_or_the_client_address():
+    key = middleware.sticky_key({"client": ("10.0.0.1", 1234)}, {b"authorization": b"Bearer secret-token"})
+    assert key.startswith("token:") and "secret-token" not in key
+    assert middleware.sticky_key({"client": ("10.0.0.1", 1234)}, {}) == "ip:10.0.0.1"
+
+    with mock.patch.object(middleware, "DB_REPLICA_STICKY_BY_IP", False):
+        assert middleware.sticky_key({"client": ("10.0.0.1", 1234)}, {}) is None
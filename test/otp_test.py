@@ -0,0 +1,66 @@
+import random
+
+import fakeredis
+import pytest
+
+from utils.exceptions import GenericError
+from utils.otp import OTPService
+
+
+def service(**kwargs):
+    return OTPService(client=fakeredis.FakeAsyncRedis(), **kwargs)
+
+
+async def test_issues_over_the_per_email_limit_are_refused():
+    otp = service(rate_limit=2, rate_window=60)
+
+    await otp.generate_otp("a@b.co")
+    await otp.generate_otp("a@b.co")
+    with pytest.raises(GenericError) as error:
+        await otp.generate_otp("a@b.co")
+    assert error.value.status_code == 429
+    # Other emails have their own window.
+    await otp.generate_otp("c@d.co")
+
+
+async def test_a_correct_code_is_consumed():
+    otp = service()
+    code = await otp.generate_otp("a@b.co")
+
+    assert await otp.verify_otp("a@b.co", code)
+    with pytest.raises(GenericError) as error:
+        await otp.verify_otp("a@b.co", code)
+    assert error.value.status_code == 400
+
+
+async def test_a_wrong_code_leaves_the_otp_in_place():
+    otp = service()
+    code = await otp.generate_otp("a@b.co")
+
+    with pytest.raises(GenericError) as error:
+        # Codes are four digits from 1000.
+        await otp.verify_otp("a@b.co", "0000")
+    assert error.value.status_code == 400
+    assert await otp.verify_otp("a@b.co", code)
+
+
+async def test_a_new_code_replaces_the_previous_one(monkeypatch):
+    codes = iter([1111, 2222])
+    monkeypatch.setattr(random, "randint", lambda low, high: next(codes))
+    otp = service()
+    assert await otp.generate_otp("a@b.co") == "1111"
+    assert await otp.generate_otp("a@b.co") == "2222"
+
+    with pytest.raises(GenericError):
+        await otp.verify_otp("a@b.co", "1111")
+    assert await otp.verify_otp("a@b.co", "2222")
+
+
+async def test_the_email_is_matched_case_insensitively():
+    otp = service(rate_limit=1, rate_window=60)
+    code = await otp.generate_otp("a@b.co")
+
+    assert await otp.verify_otp("A@B.co", code)
+    with pytest.raises(GenericError) as error:
+        await otp.generate_otp("A@b.co")
+    assert error.value.status_code == 429
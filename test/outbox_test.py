@@ -0,0 +1,75 @@
+import json
+
+import pytest
+from pydantic import BaseModel
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.outbox import queries
+from app.outbox.brokers import InMemoryBroker, SQLiteBroker
+from app.outbox.models import OutboxMessage
+from app.outbox.relay import OutboxRelay
+
+
+class Event(BaseModel):
+    event_name: str
+    to: str
+
+
+class FailingBroker(InMemoryBroker):
+    async def publish(self, queue, bodies):
+        if queue == "broken":
+            raise ConnectionError("broker down")
+        await super().publish(queue, bodies)
+
+
+@pytest.fixture
+async def sessions(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'outbox.db'}")
+    async with engine.begin() as connection:
+        await connection.run_sync(OutboxMessage.__table__.create)
+    yield async_sessionmaker(engine, expire_on_commit=False)
+    await engine.dispose()
+
+
+async def pending(sessions):
+    async with sessions() as session:
+        return (await session.execute(select(OutboxMessage).order_by(OutboxMessage.id))).scalars().all()
+
+
+async def test_only_committed_events_are_relayed_in_order(sessions):
+    async with sessions() as session:
+        queries.enqueue(session, "email", Event(event_name="REGISTER_EMAIL", to="a@b.co"))
+        queries.enqueue(session, "email", Event(event_name="REGISTER_EMAIL", to="c@d.co"))
+        await session.commit()
+        queries.enqueue(session, "email", Event(event_name="REGISTER_EMAIL", to="rolled@back.co"))
+        await session.rollback()
+
+    broker = InMemoryBroker()
+    assert await OutboxRelay(sessions, broker, batch_size=10).relay_batch() == 2
+    assert [json.loads(body)["to"] for body in broker.queues["email"]] == ["a@b.co", "c@d.co"]
+    assert await pending(sessions) == []
+
+
+async def test_failed_queue_keeps_its_rows_and_counts_attempts(sessions):
+    async with sessions() as session:
+        queries.enqueue(session, "email", Event(event_name="REGISTER_EMAIL", to="a@b.co"))
+        queries.enqueue(session, "broken", Event(event_name="REGISTER_EMAIL", to="c@d.co"))
+        await session.commit()
+
+    broker = FailingBroker()
+    with pytest.raises(ConnectionError):
+        await OutboxRelay(sessions, broker, batch_size=10).relay_batch()
+
+    [left] = await pending(sessions)
+    assert (left.queue, left.attempts) == ("broken", 1)
+    assert "broker down" in left.last_error
+    assert len(broker.queues["email"]) == 1
+
+
+async def test_sqlite_broker_persists_batches(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "broker.db"))
+    await broker.connect()
+    await broker.publish("email", [b'{"to": "a@b.co"}', b'{"to": "c@d.co"}'])
+    assert broker.messages("email") == [b'{"to": "a@b.co"}', b'{"to": "c@d.co"}']
+    await broker.close()
@@ -0,0 +1,40 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from utils.pool import InstrumentedQueuePool, PoolStats
+
+
+def test_wait_histogram_is_cumulative():
+    stats = PoolStats(buckets=(0.01, 0.1))
+    stats.observe_wait(0.005)
+    stats.observe_wait(0.05)
+    stats.observe_wait(1)
+    assert stats.histogram() == [
+        {"le": 0.01, "count": 1},
+        {"le": 0.1, "count": 2},
+        {"le": "+Inf", "count": 3},
+    ]
+    assert stats.checkouts == 3
+
+
+def test_pool_reports_checkouts_and_timeouts(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=InstrumentedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.05
+    )
+    connection = engine.connect()
+    status = engine.pool.status_dict()
+    assert status["checked_out"] == 1
+    assert status["checkouts"] == 1
+
+    with pytest.raises(PoolTimeoutError):
+        engine.connect()
+    assert engine.pool.status_dict()["timeouts"] == 1
+
+    connection.close()
+    engine.dispose()
+    assert engine.pool.status_dict()["checkouts"] == 1
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utils.exceptions import GenericError
+from utils.profiler import MemorySnapshots, SamplingProfiler
+
+
+def spin(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+async def test_process_profile_samples_other_threads():
+    profiler = SamplingProfiler(interval=0.001)
+    worker = threading.Thread(target=spin, args=(0.2,), name="busy")
+    worker.start()
+    profile = await profiler.profile(0.1)
+    worker.join()
+
+    collapsed = profile.collapsed()
+    assert any(line.startswith("busy;") and "test/profiler_test.py:spin" in line for line in collapsed.splitlines())
+    with pytest.raises(GenericError):
+        profiler.request_profile("missing")
+
+
+async def test_request_profile_only_counts_its_own_task():
+    profiler = SamplingProfiler(interval=0.001)
+
+    async def profiled():
+        profiler.start_request()
+        spin(0.05)
+        await asyncio.sleep(0.05)
+        profiler.finish_request("trace-1")
+
+    async def other():
+        await asyncio.sleep(0.01)
+        spin(0.05)
+
+    await asyncio.gather(profiled(), other())
+    stacks = profiler.request_profile("trace-1").samples
+    assert stacks
+    assert all(" other" not in stack and ":other" not in stack for stack in stacks)
+
+
+def test_memory_diff_points_at_the_allocating_line():
+    snapshots = MemorySnapshots()
+    start = snapshots.take()["id"]
+    retained = [bytearray(1024) for _ in range(2000)]
+    end = snapshots.take()["id"]
+    diff = snapshots.diff(start, end)
+    snapshots.stop()
+
+    assert diff["top"][0]["location"].startswith(__file__ + ":")
+    assert diff["top"][0]["size_diff"] >= 1024 * 2000
+    assert len(retained) == 2000
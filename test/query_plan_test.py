@@ -0,0 +1,66 @@
+"""Fails when a hot user query stops using an index.
+
+Needs a Postgres database, point QUERY_PLAN_DATABASE_URL at one (a sync
+SQLAlchemy url). Everything runs in a throwaway schema inside a
+transaction that is rolled back. Sequential scans are disabled, so the
+planner only picks one when no index matches the query.
+"""
+import os
+
+import pytest
+from sqlalchemy import create_engine, false, func, insert, select, text
+from sqlalchemy.dialects import postgresql
+
+from app.user import reads
+from app.user.models import Users
+
+QUERY_PLAN_DATABASE_URL = os.getenv("QUERY_PLAN_DATABASE_URL", "")
+
+pytestmark = pytest.mark.skipif(
+    not QUERY_PLAN_DATABASE_URL.startswith("postgresql"),
+    reason="QUERY_PLAN_DATABASE_URL does not point at Postgres"
+)
+
+HOT_QUERIES = {
+    "login": reads.login_user_statement("User1@Example.com"),
+    "principal": reads.principal_statement("user1@example.com"),
+    "email_taken": reads.email_taken_statement("user1@example.com"),
+    "unique_fields": reads.unique_fields_statement("user1@example.com", "9800000001"),
+    "introspection": select(func.lower(Users.email)).where(
+        func.lower(Users.email).in_(["user1@example.com", "user2@example.com"]), Users.is_deleted == false()
+    ),
+}
+
+
+@pytest.fixture(scope="module")
+def connection():
+    engine = create_engine(QUERY_PLAN_DATABASE_URL)
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        connection.exec_driver_sql("CREATE SCHEMA query_plan_check")
+        connection.exec_driver_sql("SET LOCAL search_path TO query_plan_check")
+        Users.__table__.create(connection)
+        connection.execute(insert(Users), [
+            {
+                "email": f"user{index}@example.com",
+                "full_name": f"User {index}",
+                "phone": f"98{index:08d}",
+                "address": "Kathmandu",
+                "password": "x",
+                "is_deleted": index % 10 == 0,
+            }
+            for index in range(2000)
+        ])
+        connection.exec_driver_sql('ANALYZE "Users"')
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        yield connection
+        transaction.rollback()
+    engine.dispose()
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+def test_hot_query_uses_an_index(connection, name):
+    sql = HOT_QUERIES[name].compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    plan = "\n".join(row[0] for row in connection.execute(text(f"EXPLAIN {sql}")))
+
+    assert "Seq Scan" not in plan, plan
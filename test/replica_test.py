@@ -0,0 +1,117 @@
+from sqlalchemy import Column, Integer, String, column, select, table, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+
+from app.user import reads
+from app.user.models import Users
+from utils import database
+from utils.database import ReplicaSet, RoutingSession, db_sticky_key_var
+
+Base = declarative_base()
+
+
+class Note(Base):
+    __tablename__ = "note"
+    id = Column(Integer, primary_key=True)
+    body = Column(String)
+
+
+async def make_engines(tmp_path):
+    engines = []
+    for name in ("primary", "replica"):
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / name}.db")
+        async with engine.begin() as connection:
+            await connection.execute(text("CREATE TABLE origin (name TEXT)"))
+            await connection.execute(text(f"INSERT INTO origin VALUES ('{name}')"))
+            await connection.run_sync(Base.metadata.create_all)
+        engines.append(engine)
+    return engines
+
+
+def origin_query():
+    return select(column("name")).select_from(table("origin"))
+
+
+async def test_reads_go_to_replica_until_the_session_writes(tmp_path):
+    primary, replica = await make_engines(tmp_path)
+    make_session = async_sessionmaker(primary, class_=AsyncSession, sync_session_class=RoutingSession,
+                                      replicas=ReplicaSet([replica]))
+
+    async with make_session() as session:
+        assert (await session.execute(origin_query())).scalar() == "replica"
+        assert (await session.execute(origin_query().with_for_update())).scalar() == "primary"
+        # Read your own writes for the rest of the session.
+        assert (await session.execute(origin_query())).scalar() == "primary"
+
+    async with make_session() as session:
+        session.add(Note(body="written"))
+        await session.flush()
+        assert (await session.execute(origin_query())).scalar() == "primary"
+
+    await primary.dispose()
+    await replica.dispose()
+
+
+async def test_lambda_reads_go_to_replica_without_marking_the_session(tmp_path):
+    primary, replica = await make_engines(tmp_path)
+    for engine in (primary, replica):
+        async with engine.begin() as connection:
+            await connection.run_sync(Users.__table__.create)
+    async with replica.begin() as connection:
+        await connection.execute(Users.__table__.insert(), {
+            "email": "a@b.co", "full_name": "Replica", "phone": "9800000000", "address": "Kathmandu",
+            "password": "x", "is_active": True,
+        })
+    make_session = async_sessionmaker(primary, class_=AsyncSession, sync_session_class=RoutingSession,
+                                      replicas=ReplicaSet([replica]))
+
+    async with make_session() as session:
+        assert (await reads.get_principal_async(session, "A@b.co")).full_name == "Replica"
+        assert (await reads.get_login_user_async(session, "a@b.co")).full_name == "Replica"
+        assert (await session.execute(reads.email_taken_statement("a@b.co"))).first() is not None
+        assert not session.sync_session.info.get("wrote")
+        assert (await session.execute(origin_query())).scalar() == "replica"
+
+    await primary.dispose()
+    await replica.dispose()
+
+
+async def test_client_sticks_to_primary_after_commit(tmp_path, monkeypatch):
+    primary, replica = await make_engines(tmp_path)
+    monkeypatch.setattr(database, "recent_writers", database.TTLCache(maxsize=10, ttl=60))
+    make_session = async_sessionmaker(primary, class_=AsyncSession, sync_session_class=RoutingSession,
+                                      replicas=ReplicaSet([replica]))
+    token = db_sticky_key_var.set("10.0.0.1")
+    try:
+        async with make_session() as session:
+            session.add(Note(body="written"))
+            await session.commit()
+
+        async with make_session() as session:
+            assert (await session.execute(origin_query())).scalar() == "primary"
+
+        db_sticky_key_var.set("10.0.0.2")
+        async with make_session() as session:
+            assert (await session.execute(origin_query())).scalar() == "replica"
+    finally:
+        db_sticky_key_var.reset(token)
+
+    await primary.dispose()
+    await replica.dispose()
+
+
+async def test_unhealthy_replica_falls_back_to_primary(tmp_path):
+    primary, replica = await make_engines(tmp_path)
+    broken = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    replicas = ReplicaSet([broken, replica])
+    await replicas.check()
+    assert replicas.healthy == [replica]
+
+    replicas.healthy = []
+    make_session = async_sessionmaker(primary, class_=AsyncSession, sync_session_class=RoutingSession,
+                                      replicas=replicas)
+    async with make_session() as session:
+        assert (await session.execute(origin_query())).scalar() == "primary"
+
+    for engine in (primary, replica, broken):
+        await engine.dispose()
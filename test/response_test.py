@@ -0,0 +1,47 @@
+import json
+from datetime import datetime
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+from utils import response
+
+
+class Details(BaseModel):
+    id: int
+    full_name: str
+    created_at: datetime
+
+
+def legacy_body(content):
+    # What JSONResponse(content=jsonable_encoder(content)) used to render.
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+
+def test_success_with_model_matches_legacy_bytes():
+    details = Details(id=1, full_name="Tëst User", created_at=datetime(2024, 5, 1, 10, 30, 0, 123))
+    rendered = response.success(status_code=200, message="ok", data=details, warning=None)
+    expected = legacy_body({"message": "ok", "success": True, "data": details.model_dump(), "warning": None})
+    assert rendered.body == expected
+    assert rendered.headers["content-type"] == "application/json"
+
+
+def test_error_matches_legacy_bytes():
+    rendered = response.error(422, "Invalid data.", {"email": "Email is required."})
+    expected = legacy_body({"message": "Invalid data.", "success": False, "data": None,
+                            "errors": {"email": "Email is required."}})
+    assert rendered.body == expected
+    assert rendered.status_code == 422
+
+
+def test_static_envelope_is_reused():
+    first = response.success(message="Email verified successfully.")
+    second = response.success(message="Email verified successfully.")
+    assert first.body is second.body
+    assert first.body == legacy_body({"message": "Email verified successfully.", "success": True,
+                                      "data": None, "warning": None})
+
+
+def test_non_string_message_is_not_cached():
+    rendered = response.error(400, {"detail": "bad"})
+    assert json.loads(rendered.body)["message"] == {"detail": "bad"}
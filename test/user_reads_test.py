@@ -0,0 +1,68 @@
+import pytest
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.user.models import Users
+from app.user.queries import check_user_uniqueness_async, update_password_hash_async
+from app.user.reads import LoginUser, get_login_user_async, get_principal_async
+from app.user.schema import UserDetails
+from utils.exceptions import GenericError
+
+
+@pytest.fixture
+async def session(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'reads.db'}")
+    async with engine.begin() as connection:
+        await connection.run_sync(Users.__table__.create)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessions() as session:
+        session.add_all([
+            Users(email="a@b.co", full_name="A", phone="9800000000", address="Kathmandu", password="x",
+                  is_active=True),
+            Users(email="new@b.co", full_name="N", phone="9800000001", address="Kathmandu", password="x"),
+        ])
+        await session.commit()
+        session.expunge_all()
+        yield session
+    await engine.dispose()
+
+
+async def test_login_read_returns_a_plain_row_and_keeps_the_errors(session):
+    user = await get_login_user_async(session, "a@b.co")
+
+    assert isinstance(user, LoginUser) and not hasattr(user, "__dict__")
+    assert (user.email, user.password, user.is_active) == ("a@b.co", "x", True)
+    assert not session.identity_map
+    assert (await get_login_user_async(session, "A@B.co")).email == "a@b.co"
+    with pytest.raises(GenericError, match="User not active"):
+        await get_login_user_async(session, "new@b.co")
+    with pytest.raises(GenericError, match="User not found"):
+        await get_login_user_async(session, "ghost@b.co")
+
+
+async def test_principal_read_validates_into_user_details(session):
+    principal = UserDetails.from_orm(await get_principal_async(session, "a@b.co"))
+
+    assert principal.email == "a@b.co" and principal.phone == "9800000000" and principal.created_at
+    assert await get_principal_async(session, "ghost@b.co") is None
+
+
+async def test_rehash_does_not_overwrite_a_password_changed_meanwhile(session):
+    verified_hash = (await get_login_user_async(session, "a@b.co")).password
+    # A password change commits while login is still verifying the old hash.
+    await session.execute(update(Users).where(Users.email == "a@b.co").values(password="changed"))
+    await session.commit()
+
+    assert not await update_password_hash_async(session, "a@b.co", old_hash=verified_hash, hashed_password="rehash")
+    assert (await get_login_user_async(session, "a@b.co")).password == "changed"
+    assert await update_password_hash_async(session, "a@b.co", old_hash="changed", hashed_password="rehash")
+    assert (await get_login_user_async(session, "a@b.co")).password == "rehash"
+
+
+async def test_emails_differing_only_in_case_are_the_same_user(session):
+    with pytest.raises(GenericError, match="already exists"):
+        await check_user_uniqueness_async(session, "A@B.co", "9811111111")
+    with pytest.raises(IntegrityError):
+        session.add(Users(email="A@B.CO", full_name="B", phone="9811111111", address="Kathmandu", password="x"))
+        await session.flush()
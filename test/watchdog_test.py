@@ -0,0 +1,36 @@
+import asyncio
+import time
+
+from utils.watchdog import LoopWatchdog
+
+
+def block_the_loop():
+    time.sleep(0.2)
+
+
+async def test_stall_is_attributed_to_call_site():
+    watchdog = LoopWatchdog(threshold=0.05, interval=0.01)
+    await watchdog.start()
+
+    async def request():
+        watchdog.track("trace-1")
+        block_the_loop()
+
+    await asyncio.create_task(request())
+    await asyncio.sleep(0.05)
+    await watchdog.stop()
+
+    stats = watchdog.stats()
+    assert stats["max_lag"] >= 0.15
+    [(site, count)] = stats["stalls"].items()
+    assert site.startswith("test/watchdog_test.py") and site.endswith("in block_the_loop")
+    assert count == 1
+    assert watchdog.running is False
+
+
+async def test_quiet_loop_reports_no_stalls():
+    watchdog = LoopWatchdog(threshold=0.05, interval=0.01)
+    await watchdog.start()
+    await asyncio.sleep(0.1)
+    await watchdog.stop()
+    assert watchdog.stats()["stalls"] == {}
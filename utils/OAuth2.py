@@ -1,14 +1,18 @@
+import time
 from datetime import datetime
 from http import HTTPStatus
+from typing import Optional
 
-from fastapi import Depends
+from fastapi import Depends, Header
 from fastapi.security import OAuth2PasswordBearer
-from jose import jwt
+from sqlalchemy import false, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.user.models import Users
-from app.user.schema import TokenPayload
-from utils import exceptions
-from utils.variables import ALGORITHM, JWT_SECRET_KEY
+from app.user.reads import get_principal_async
+from app.user.schema import TokenPayload, UserDetails
+from utils import cache, exceptions, helpers, jwt_token
+from utils.database import get_async_db
 
 reusable_oauth = OAuth2PasswordBearer(
     tokenUrl="/login",
@@ -16,21 +20,62 @@ reusable_oauth = OAuth2PasswordBearer(
 )
 
 
-def get_current_user(token: str = Depends(reusable_oauth)) -> Users:
-    payload = jwt.decode(
-        token, JWT_SECRET_KEY, algorithms=[ALGORITHM]
-    )
-    token_data = TokenPayload(**payload)
+def decode_token(token: str) -> TokenPayload:
+    """Verify the token signature once, later calls with the same token are served from the cache."""
+    digest = cache.token_digest(token)
+    token_data = cache.token_cache.get(digest)
+    if token_data is None:
+        token_data = TokenPayload(**jwt_token.decode_access_token(token))
+        cache.token_cache.set(digest, token_data, ttl=token_data.exp - time.time())
+
     if datetime.fromtimestamp(token_data.exp) < datetime.now():
         raise exceptions.GenericError(
             message="Token is expired",
             status_code=HTTPStatus.UNAUTHORIZED
         )
+    return token_data
+
 
-    user = Users.query.filter_by(email=token_data.sub).first()
+async def get_user_by_subject(session: AsyncSession, subject: str) -> Users:
+    result = await session.execute(
+        select(Users).where(func.lower(Users.email) == func.lower(subject), Users.is_deleted == false())
+    )
+    user = result.scalars().first()
     if user is None:
         raise exceptions.GenericError(
             message="User not found",
             status_code=HTTPStatus.NOT_FOUND
         )
     return user
+
+
+async def get_current_user(token: str = Depends(reusable_oauth),
+                           session: AsyncSession = Depends(get_async_db)) -> Users:
+    token_data = decode_token(token)
+    return await get_user_by_subject(session, token_data.sub)
+
+
+async def get_current_principal(token: str = Depends(reusable_oauth),
+                                session: AsyncSession = Depends(get_async_db)) -> UserDetails:
+    """Read only view of the current user, served from the principal cache when it is warm."""
+    token_data = decode_token(token)
+    principal = cache.principal_cache.get(token_data.sub)
+    if principal is None:
+        user = await get_principal_async(session, token_data.sub)
+        if user is None:
+            raise exceptions.GenericError(
+                message="User not found",
+                status_code=HTTPStatus.NOT_FOUND
+            )
+        principal = UserDetails.from_orm(user)
+        cache.principal_cache.set(token_data.sub, principal)
+    return principal
+
+
+def verify_internal_token(x_internal_token: Optional[str] = Header(default=None)) -> None:
+    """Guard for internal endpoints that can slow the worker down or expose its internals."""
+    if not helpers.internal_token_matches(x_internal_token):
+        raise exceptions.GenericError(
+            message="Invalid internal token",
+            status_code=HTTPStatus.FORBIDDEN
+        )
@@ -0,0 +1,131 @@
+import math
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from redis.exceptions import RedisError
+
+from utils import metrics, redis_client
+from utils.cache import TTLCache
+from utils.exceptions import GenericError
+from utils.log import StructuredMessage, logger
+from utils.variables import (LOGIN_ADMISSION_ENABLED, LOGIN_EMAIL_LIMIT, LOGIN_EMAIL_WINDOW, LOGIN_IP_LIMIT,
+                             LOGIN_IP_WINDOW)
+
+# One sorted set of attempt timestamps per key. The attempt is only recorded when every key
+# is under its limit, otherwise returns which key refused it and the ms until its oldest attempt expires.
+# ARGV: now in ms, attempt id, then a limit and a window in ms per key.
+SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    local limit = tonumber(ARGV[1 + i * 2])
+    local window = tonumber(ARGV[2 + i * 2])
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    if redis.call('ZCARD', key) >= limit then
+        local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        return {i, tonumber(oldest[2]) + window - now}
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, ARGV[2])
+    redis.call('PEXPIRE', key, ARGV[2 + i * 2])
+end
+return {0, 0}
+"""
+
+
+class TokenBucket:
+    """`capacity` attempts at once, refilled evenly over `window` seconds."""
+
+    def __init__(self, capacity: int, window: float):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token and return 0, or return the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """Admits login attempts before they cost a database lookup and a password hash.
+
+    Attempts are counted per email and per client IP in Redis sliding
+    windows shared by every worker. When Redis fails, including the socket
+    timeout of `client` running out, the worker falls back to its own token
+    buckets with the same limits, which are per process and so only a
+    coarse guard.
+
+    The call is never cancelled from here, `client` should carry a socket
+    timeout as short as a login can wait (see redis_client.admission_client).
+    A timeout can still come after Redis ran the script, and then that
+    attempt counts in both the window and the local bucket.
+    """
+
+    def __init__(self, client, limits: Dict[str, Tuple[int, float]], prefix: str = "admission:login"):
+        self.limits = limits
+        self.prefix = prefix
+        self.script = client.register_script(SLIDING_WINDOW_SCRIPT)
+        longest_window = max(window for _, window in limits.values())
+        self.buckets = TTLCache(maxsize=100000, ttl=longest_window)
+
+    async def admit(self, **subjects: Optional[str]) -> None:
+        """Raise a 429 when any subject (scope=value, e.g. email=..., ip=...) is over its limit."""
+        subjects = {scope: value for scope, value in subjects.items() if value}
+        if not subjects:
+            return
+        try:
+            scope, retry_after = await self.check_redis(subjects)
+            backend = "redis"
+        except RedisError as e:
+            metrics.ADMISSION_FALLBACKS.inc()
+            logger.warning(StructuredMessage("Admission falling back to local buckets", {"error": repr(e)}))
+            scope, retry_after = self.check_local(subjects)
+            backend = "local"
+
+        if scope is not None:
+            metrics.ADMISSION_SHED.labels(scope, backend).inc()
+            raise GenericError(
+                message="Too many login attempts. Please try again later.",
+                status_code=429,
+                headers={"Retry-After": str(max(math.ceil(retry_after), 1))}
+            )
+
+    async def check_redis(self, subjects: Dict[str, str]) -> Tuple[Optional[str], float]:
+        scopes = list(subjects)
+        args = [int(time.time() * 1000), os.urandom(8).hex()]
+        for scope in scopes:
+            limit, window = self.limits[scope]
+            args += [limit, int(window * 1000)]
+        refused, retry_after_ms = await self.script(
+            keys=[f"{self.prefix}:{scope}:{subjects[scope]}" for scope in scopes],
+            args=args
+        )
+        if refused == 0:
+            return None, 0.0
+        return scopes[refused - 1], retry_after_ms / 1000
+
+    def check_local(self, subjects: Dict[str, str]) -> Tuple[Optional[str], float]:
+        for scope, value in subjects.items():
+            key = (scope, value)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(*self.limits[scope])
+                self.buckets.set(key, bucket)
+            retry_after = bucket.take()
+            if retry_after:
+                return scope, retry_after
+        return None, 0.0
+
+
+login_admission = AdmissionController(
+    client=redis_client.admission_client,
+    limits={"email": (LOGIN_EMAIL_LIMIT, LOGIN_EMAIL_WINDOW), "ip": (LOGIN_IP_LIMIT, LOGIN_IP_WINDOW)},
+) if LOGIN_ADMISSION_ENABLED else None
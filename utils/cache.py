@@ -0,0 +1,77 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from utils.variables import (INTROSPECTION_CACHE_SIZE, INTROSPECTION_CACHE_TTL, PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL,
+                             TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after a time to live (in seconds)."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] <= now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Store `value`, the entry lives for `ttl` seconds but never longer than the cache ttl."""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+def token_digest(token: str) -> str:
+    """Cache key for a bearer token, so raw tokens are never kept in memory as keys."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# Verified access token payloads, keyed by token digest.
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
+# Serialized users keyed by email. Invalidation is per process, hence the short ttl.
+principal_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+
+# Introspection results keyed by token digest, see app/internal/queries.py.
+introspection_cache = TTLCache(maxsize=INTROSPECTION_CACHE_SIZE, ttl=INTROSPECTION_CACHE_TTL)
+
+
+def invalidate_principal(email: str) -> None:
+    principal_cache.delete(email)
@@ -1,17 +1,231 @@
-from sqlalchemy import create_engine
+import asyncio
+import itertools
+import os
+import re
+import sys
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+import greenlet
+
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
 
 from utils import store
+from utils.cache import TTLCache
 from utils.constant import *
-from utils.variables import DATABASE_URL
+from utils.exceptions import DatabaseConnectionProblem
+from utils.log import StructuredMessage, logger, trace_id_var
+from utils.pool import InstrumentedAsyncQueuePool, InstrumentedQueuePool
+from utils.variables import (ASYNC_DATABASE_URL, DATABASE_REPLICA_URLS, DATABASE_URL, DB_MAX_OVERFLOW,
+                             DB_POOL_PRE_PING, DB_POOL_RECYCLE, DB_POOL_SIZE, DB_POOL_TIMEOUT,
+                             DB_REPLICA_HEALTH_INTERVAL, DB_REPLICA_STICKY_SECONDS, DB_SLOW_QUERY_MS)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SQL_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
 
 # Create the base class for declarative models
 Base = declarative_base()
 
 
+class RequestDatabaseStats:
+    """Database usage of a single request, reported in the request log line."""
+
+    def __init__(self):
+        self.transactions = 0
+        self.connection_hold_time = 0.0
+        self.statements = 0
+        self.time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+
+    def record_statement(self, statement: str, elapsed: float) -> None:
+        self.statements += 1
+        self.time += elapsed
+        if elapsed > self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest_statement = statement
+
+    def as_log_dict(self) -> dict:
+        return {
+            "db_transactions": self.transactions,
+            "db_connection_hold_time": f"{self.connection_hold_time:.4f}",
+            "db_statements": self.statements,
+            "db_time": f"{self.time:.4f}",
+            "db_slowest_time": f"{self.slowest_time:.4f}",
+            "db_slowest_statement": normalize_sql(self.slowest_statement) if self.slowest_statement else None,
+        }
+
+
+# Set per request by the logging middleware, None outside of a request.
+db_stats_var: ContextVar[Optional[RequestDatabaseStats]] = ContextVar("db_stats", default=None)
+
+# Identifies the client of the current request for read-your-writes, set by the logging middleware.
+db_sticky_key_var: ContextVar[Optional[str]] = ContextVar("db_sticky_key", default=None)
+
+# Clients that committed a write recently, their reads stay on the primary. Per process.
+recent_writers = TTLCache(maxsize=100000, ttl=DB_REPLICA_STICKY_SECONDS)
+
+
+class RequestSession(Session):
+    """Session whose connection hold time is added to the current request's stats."""
+
+
+@event.listens_for(RequestSession, "after_begin")
+def connection_acquired(session, transaction, connection):
+    session.info.setdefault("connection_acquired_at", time.perf_counter())
+
+
+@event.listens_for(RequestSession, "after_transaction_end")
+def connection_released(session, transaction):
+    if transaction.parent is not None or "connection_acquired_at" not in session.info:
+        return
+    held = time.perf_counter() - session.info.pop("connection_acquired_at")
+    stats = db_stats_var.get()
+    if stats is not None:
+        stats.transactions += 1
+        stats.connection_hold_time += held
+
+
+class ReplicaSet:
+    """Round robin over the replica engines that passed their last health check."""
+
+    def __init__(self, engines: list):
+        self.engines = list(engines)
+        self.healthy = list(engines)
+        self.counter = itertools.count()
+
+    def choose(self):
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self.counter) % len(healthy)]
+
+    async def check(self) -> None:
+        healthy = []
+        for engine in self.engines:
+            try:
+                async with engine.connect() as connection:
+                    await connection.execute(text("SELECT 1"))
+            except Exception as e:
+                logger.warning(StructuredMessage("Database replica unhealthy", {
+                    "replica": engine.url.render_as_string(hide_password=True),
+                    "error": repr(e),
+                }))
+                continue
+            healthy.append(engine)
+        self.healthy = healthy
+
+    async def monitor(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.check()
+
+
+class RoutingSession(RequestSession):
+    """Sends plain reads to a healthy replica and everything else to the primary.
+
+    Writes, flushes, SELECT ... FOR UPDATE, raw SQL and any statement after
+    the session wrote go to the primary. So do the reads of a client for
+    DB_REPLICA_STICKY_SECONDS after it committed a write, which keeps a
+    signup followed by its OTP verification from reading a lagging replica.
+    """
+
+    def __init__(self, *args, replicas: Optional[ReplicaSet] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.reads_from_replica(clause):
+            replica = self.replicas.choose()
+            if replica is not None:
+                return replica.sync_engine
+        return super().get_bind(mapper, clause=clause, **kwargs)
+
+    def reads_from_replica(self, clause) -> bool:
+        if self.replicas is None or self._flushing or self.info.get("wrote"):
+            return False
+        # lambda_stmt()s wrap their statement, look at the one they resolve to.
+        statement = getattr(clause, "_resolved", clause)
+        if not getattr(clause, "is_select", False) or getattr(statement, "_for_update_arg", None) is not None:
+            if clause is not None:
+                self.info["wrote"] = True
+            return False
+        sticky_key = db_sticky_key_var.get()
+        return sticky_key is None or recent_writers.get(sticky_key) is None
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def session_wrote(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def remember_writer(session):
+    sticky_key = db_sticky_key_var.get()
+    if session.info.get("wrote") and sticky_key is not None:
+        recent_writers.set(sticky_key, True)
+
+
+def normalize_sql(statement: str) -> str:
+    """Single line SQL with literals replaced, so equal queries group together in the logs."""
+    return " ".join(SQL_LITERAL_PATTERN.sub("?", statement).split())
+
+
+def call_site() -> Optional[str]:
+    """First frame of our own code that led to the statement.
+
+    Under the async engine the statement runs in a greenlet spawned by the
+    awaiting coroutine, whose frames live in the parent greenlet's stack.
+    """
+    frames = [sys._getframe(1)]
+    parent = greenlet.getcurrent().parent
+    while parent is not None:
+        if parent.gr_frame is not None:
+            frames.append(parent.gr_frame)
+        parent = parent.parent
+
+    for frame in frames:
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if filename.startswith(PROJECT_ROOT) and filename != __file__ and "site-packages" not in filename:
+                return f"{os.path.relpath(filename, PROJECT_ROOT)}:{frame.f_lineno} in {frame.f_code.co_name}"
+            frame = frame.f_back
+    return None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's own context, a failed statement then leaves nothing behind on the connection.
+    context._query_start_time = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_start_time
+    stats = db_stats_var.get()
+    if stats is not None:
+        stats.record_statement(statement, elapsed)
+
+    if elapsed * 1000 >= DB_SLOW_QUERY_MS:
+        log_dict = {
+            "trace_id": trace_id_var.get(),
+            "duration": f"{elapsed:.4f}",
+            "statement": normalize_sql(statement),
+            "call_site": call_site(),
+        }
+        logger.warning(StructuredMessage("Slow query", log_dict))
+
+
+def instrument_engine(engine) -> None:
+    """Time every statement of `engine` (a sync Engine, use .sync_engine for async ones)."""
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
 def attach_query_property():
     """Attach a `query` property to the Base class for easy queries."""
     Base.query = store.session.query_property()
@@ -20,17 +234,30 @@ def attach_query_property():
 def register_models():
     """Register all models to be used with SQLAlchemy."""
     from app.user.models import Users  # noqa: F401
+    from app.outbox.models import OutboxMessage  # noqa: F401
     from app.payments.models import UserPayment  # noqa: F401
     from app.orders.models import Orders  # noqa: F401
 
 
+def pool_options() -> dict:
+    """Pool settings shared by the sync and the async engine."""
+    return dict(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
 def connect_to_database() -> bool:
     """Connect to the database using the provided URI."""
     try:
         connection_uri = DATABASE_URL
         engine = create_engine(
             connection_uri,
-            poolclass=StaticPool,  # Use StaticPool for in-memory databases or testing
+            poolclass=InstrumentedQueuePool,
+            **pool_options(),
             echo=False  # Set echo=True for SQL logging during development
         )
     except OperationalError as oe:
@@ -38,6 +265,8 @@ def connect_to_database() -> bool:
             store.has_connection_established = False
         return store.has_connection_established
 
+    instrument_engine(engine)
+
     _session = sessionmaker(
         bind=engine,
         autocommit=False,
@@ -55,6 +284,41 @@ def connect_to_database() -> bool:
     return store.has_connection_established
 
 
+def create_instrumented_async_engine(url: str):
+    engine = create_async_engine(
+        url,
+        poolclass=InstrumentedAsyncQueuePool,
+        **pool_options(),
+        echo=False
+    )
+    instrument_engine(engine.sync_engine)
+    return engine
+
+
+def connect_to_async_database() -> bool:
+    """Create the asyncpg backed engine and session factory used by the routes.
+
+    With DATABASE_REPLICA_URLS set, sessions route their reads to the replicas.
+    """
+    engine = create_instrumented_async_engine(ASYNC_DATABASE_URL)
+    store.async_engine = engine
+    session_options = dict(sync_session_class=RequestSession)
+    if DATABASE_REPLICA_URLS:
+        store.replicas = ReplicaSet([create_instrumented_async_engine(url) for url in DATABASE_REPLICA_URLS])
+        session_options = dict(sync_session_class=RoutingSession, replicas=store.replicas)
+    store.async_session = async_sessionmaker(
+        bind=engine,
+        class_=AsyncSession,
+        autoflush=False,
+        expire_on_commit=False,
+        **session_options
+    )
+
+    register_models()
+
+    return True
+
+
 def disconnect_from_database():
     """Disconnect from the database and clean up resources."""
     if store.session:
@@ -64,11 +328,81 @@ def disconnect_from_database():
     store.has_connection_established = False
 
 
+def start_replica_health_checks() -> None:
+    """Re-check the replicas every DB_REPLICA_HEALTH_INTERVAL seconds, called from the app startup event."""
+    if store.replicas and store.replica_monitor is None:
+        store.replica_monitor = asyncio.create_task(store.replicas.monitor(DB_REPLICA_HEALTH_INTERVAL))
+
+
+async def disconnect_from_async_database():
+    """Dispose the async engines and close their pooled connections."""
+    if store.replica_monitor:
+        store.replica_monitor.cancel()
+        store.replica_monitor = None
+    if store.replicas:
+        for replica in store.replicas.engines:
+            await replica.dispose()
+    if store.async_engine:
+        await store.async_engine.dispose()
+    store.async_engine = None
+    store.async_session = None
+    store.replicas = None
+
+
 def rollback_session():
-    """Rollback the session in case of an error."""
-    if store.session:
+    """Rollback the sync session, but only if it actually began a transaction."""
+    if store.session and store.session.registry.has() and store.session().in_transaction():
         store.session.rollback()
 
 
 def get_db():
     return store.session()
+
+
+async def get_async_db():
+    """Request scoped AsyncSession.
+
+    No connection is checked out until the first statement runs. Work left
+    uncommitted is rolled back and the connection goes back to the pool as
+    soon as the response is produced, before it is sent. Sessions that never
+    began a transaction are simply discarded.
+    """
+    if not store.async_session:
+        raise DatabaseConnectionProblem()
+    session = store.async_session()
+    try:
+        yield session
+    finally:
+        if session.in_transaction():
+            await session.rollback()
+        await session.close()
+
+
+async def release_connection(session: AsyncSession) -> None:
+    """End the current read transaction so the connection is not held across slow non database work.
+
+    Commit rather than rollback, loaded objects are not expired (expire_on_commit=False).
+    """
+    if session.in_transaction():
+        await session.commit()
+
+
+def get_pool_status() -> dict:
+    """Return the connection pool usage and checkout wait statistics."""
+    if not store.engine and not store.async_engine:
+        raise DatabaseConnectionProblem()
+    status = {}
+    if store.engine:
+        status["sync"] = store.engine.pool.status_dict()
+    if store.async_engine:
+        status["async"] = store.async_engine.pool.status_dict()
+    if store.replicas:
+        status["replicas"] = [
+            {
+                "url": replica.url.render_as_string(hide_password=True),
+                "healthy": replica in store.replicas.healthy,
+                **replica.pool.status_dict(),
+            }
+            for replica in store.replicas.engines
+        ]
+    return status
@@ -27,10 +27,11 @@ class GenericError(Exception):
     """The custom error that is raised when validation fails."""
 
     def __init__(self, status_code: int = ERROR_BAD_REQUEST, message: Optional[str] = None,
-                 errors: Optional[dict] = None, *args, **kwargs) -> None:
+                 errors: Optional[dict] = None, headers: Optional[dict] = None, *args, **kwargs) -> None:
         self.status_code = status_code
         self.message = message
         self.errors = errors
+        self.headers = headers
         super().__init__(message)
 
 
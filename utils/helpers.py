@@ -1,3 +1,9 @@
+import hmac
+from typing import Optional
+
+from utils.variables import INTERNAL_API_TOKEN
+
+
 def pydantic_error(err):
     if hasattr(err, 'errors'):
         errors = err.errors()
@@ -39,3 +45,10 @@ def pydantic_error(err):
             msg[field] = f"{field.capitalize()} {error_msg}."
 
     return {"body": msg}
+
+
+def internal_token_matches(token: Optional[str]) -> bool:
+    """Constant time check of an X-Internal-Token value, always False while no token is configured."""
+    if not INTERNAL_API_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode(), INTERNAL_API_TOKEN.encode())
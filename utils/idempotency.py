@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import json
+import time
+from typing import Dict, Iterable, Optional
+
+from redis.exceptions import RedisError
+
+from utils import metrics
+from utils.log import StructuredMessage, logger
+from utils.response import error
+
+# Claims the key for this request unless it exists, in which case its current state is returned:
+# the fingerprint alone while the first request is in flight, the stored response once it finished.
+CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('HMGET', KEYS[1], 'fingerprint', 'status', 'headers', 'body')
+end
+redis.call('HSET', KEYS[1], 'fingerprint', ARGV[1])
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return false
+"""
+
+MAX_KEY_LENGTH = 255
+
+# Responses that ask the client to try again later, storing them would refuse every retry until the ttl.
+RETRY_LATER_STATUSES = frozenset({408, 425, 429})
+
+
+class IdempotencyMiddleware:
+    """Pure ASGI middleware that runs a POST carrying an Idempotency-Key at most once.
+
+    The first request with a key claims it in Redis for `lock_ttl` seconds
+    and runs. Its response (status, headers and body) is stored for `ttl`
+    seconds, unless it is a 5xx or asks to retry later (429 and the like),
+    and later requests with the same key and the same body get that
+    response back with `Idempotency-Replayed: true`.
+    Duplicates that arrive while the first one is running wait for it,
+    on an in-process event when it runs in the same worker and by polling
+    Redis otherwise, for up to `wait_timeout` seconds. If Redis is down,
+    requests run as if they had no key.
+    """
+
+    def __init__(self, app, client, paths: Iterable[str], ttl: float = 86400, lock_ttl: float = 60,
+                 wait_timeout: float = 10, poll_interval: float = 0.1, max_body_size: int = 65536,
+                 prefix: str = "idempotency"):
+        self.app = app
+        self.paths = frozenset(paths)
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.max_body_size = max_body_size
+        self.prefix = prefix
+        self.redis = client
+        self.claim_script = client.register_script(CLAIM_SCRIPT)
+        # Keys whose first request runs in this worker.
+        self.in_flight: Dict[str, asyncio.Event] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        idempotency_key = headers.get(b"idempotency-key", b"").decode()
+        if not idempotency_key:
+            await self.app(scope, receive, send)
+            return
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            await error(status_code=400, message="Idempotency-Key is too long.")(scope, receive, send)
+            return
+
+        body = await read_body(receive)
+        digest = hashlib.sha256()
+        for part in (scope["path"].encode(), headers.get(b"authorization", b""), body):
+            digest.update(part)
+            digest.update(b"\0")
+        fingerprint = digest.hexdigest()
+        key = f"{self.prefix}:{scope['path']}:{idempotency_key}"
+
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            try:
+                state = await self.claim_script(keys=[key], args=[fingerprint, int(self.lock_ttl * 1000)])
+            except RedisError as e:
+                logger.warning(StructuredMessage("Idempotency key not checked", {"error": repr(e)}))
+                await self.app(scope, replay_receive(body, receive), send)
+                return
+
+            if state is None:
+                await self.run_first(scope, receive, send, key, body)
+                return
+
+            stored_fingerprint, status_code, stored_headers, stored_body = state
+            if stored_fingerprint is not None and stored_fingerprint.decode() != fingerprint:
+                await error(
+                    status_code=422,
+                    message="Idempotency-Key was already used for a different request."
+                )(scope, receive, send)
+                return
+            if status_code is not None:
+                metrics.IDEMPOTENT_REPLAYS.labels(scope["path"]).inc()
+                await replay(send, int(status_code), stored_headers, stored_body)
+                return
+
+            if time.monotonic() >= deadline:
+                response = error(
+                    status_code=409,
+                    message="A request with this Idempotency-Key is still being processed."
+                )
+                response.headers["Retry-After"] = "1"
+                await response(scope, receive, send)
+                return
+            await self.wait(key, deadline)
+
+    async def wait(self, key: str, deadline: float) -> None:
+        """Until the first request finishes here, or one poll interval when it runs elsewhere."""
+        event = self.in_flight.get(key)
+        timeout = max(deadline - time.monotonic(), 0)
+        if event is None:
+            await asyncio.sleep(min(self.poll_interval, timeout))
+            return
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run_first(self, scope, receive, send, key: str, body: bytes) -> None:
+        self.in_flight[key] = event = asyncio.Event()
+        start = {}
+        chunks = []
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal size
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                size += len(chunks[-1])
+            await send(message)
+
+        stored = False
+        try:
+            await self.app(scope, replay_receive(body, receive), send_wrapper)
+            if (start and start["status"] < 500 and start["status"] not in RETRY_LATER_STATUSES
+                    and size <= self.max_body_size):
+                stored = await self.store(key, start, b"".join(chunks))
+        finally:
+            if not stored:
+                # Let a retry run it again.
+                await self.release(key)
+            del self.in_flight[key]
+            event.set()
+
+    async def store(self, key: str, start: dict, body: bytes) -> bool:
+        headers = [[name.decode("latin-1"), value.decode("latin-1")] for name, value in start.get("headers", [])]
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping={"status": start["status"], "headers": json.dumps(headers), "body": body})
+                pipe.pexpire(key, int(self.ttl * 1000))
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning(StructuredMessage("Idempotent response not stored", {"error": repr(e)}))
+            return False
+        return True
+
+    async def release(self, key: str) -> None:
+        try:
+            await self.redis.delete(key)
+        except RedisError as e:
+            # The claim expires after lock_ttl anyway.
+            logger.warning(StructuredMessage("Idempotency key not released", {"error": repr(e)}))
+
+
+async def read_body(receive) -> bytes:
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        body.extend(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return bytes(body)
+
+
+def replay_receive(body: bytes, receive):
+    """A receive that hands the already read body to the app, then defers to the real one."""
+    sent = False
+
+    async def receive_body():
+        nonlocal sent
+        if sent:
+            return await receive()
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return receive_body
+
+
+async def replay(send, status_code: int, stored_headers: Optional[bytes], body: Optional[bytes]) -> None:
+    headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in json.loads(stored_headers or "[]")]
+    headers.append((b"idempotency-replayed", b"true"))
+    await send({"type": "http.response.start", "status": status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": body or b""})
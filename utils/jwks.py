@@ -0,0 +1,154 @@
+"""ES256 signing keys, their JWKS and a verifier that caches parsed keys.
+
+Every `<kid>.pem` file in JWT_KEYS_DIR is an EC P-256 private key. New
+access tokens are signed with JWT_ACTIVE_KID, or with the last kid in sort
+order when it is unset, and all keys in the directory are published at
+/.well-known/jwks.json. To rotate, add a new key (dated kids sort
+naturally), and delete the old file once the tokens it signed expired.
+The directory is re-read when it changes, no restart needed.
+
+    python -m utils.jwks generate <directory> [kid]
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional, Tuple
+
+import httpx
+from jose import jwk, jwt
+from jose.backends.base import Key
+
+
+class KeyStore:
+    def __init__(self, directory: str, algorithm: str = "ES256", active_kid: Optional[str] = None,
+                 refresh_interval: float = 30):
+        self.directory = directory
+        self.algorithm = algorithm
+        self.active_kid = active_kid
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.next_check = 0.0
+        self.private_keys: Dict[str, Key] = {}
+        self.public_keys: Dict[str, Key] = {}
+        self.jwks_body = b'{"keys":[]}'
+        self.etag = ""
+
+    def refresh(self) -> None:
+        """Reload the keys if the directory changed, at most every `refresh_interval` seconds."""
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        with self.lock:
+            self.next_check = now + self.refresh_interval
+            mtime = os.stat(self.directory).st_mtime_ns
+            if mtime != self.mtime:
+                self.load()
+                self.mtime = mtime
+
+    def load(self) -> None:
+        private_keys, public_keys, published = {}, {}, []
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith(".pem"):
+                continue
+            kid = filename[:-len(".pem")]
+            with open(os.path.join(self.directory, filename)) as key_file:
+                private_keys[kid] = jwk.construct(key_file.read(), self.algorithm)
+            public_keys[kid] = private_keys[kid].public_key()
+            published.append({**public_keys[kid].to_dict(), "kid": kid, "use": "sig", "alg": self.algorithm})
+
+        self.private_keys, self.public_keys = private_keys, public_keys
+        self.jwks_body = json.dumps({"keys": published}, separators=(",", ":")).encode()
+        self.etag = f'"{hashlib.sha256(self.jwks_body).hexdigest()[:32]}"'
+
+    def signing_key(self) -> Tuple[str, Key]:
+        self.refresh()
+        kid = self.active_kid or max(self.private_keys, default=None)
+        if kid not in self.private_keys:
+            raise RuntimeError(f"No signing key {kid!r} in {self.directory}")
+        return kid, self.private_keys[kid]
+
+    def jwks(self) -> dict:
+        self.refresh()
+        return json.loads(self.jwks_body)
+
+
+class UnknownKeyError(jwt.JWTError):
+    """The token names a kid the JWKS does not have (yet)."""
+
+
+class TokenVerifier:
+    """Verifies JWTs against a JWKS, keeping the parsed key object of every kid.
+
+    A token with an unknown kid refetches the JWKS, but not more often than
+    `min_refresh_interval`, which is how keys rotated in upstream are picked
+    up. Downstream services build one with TokenVerifier.from_url().
+    """
+
+    def __init__(self, fetch_jwks: Callable[[], dict], algorithms=("ES256",), min_refresh_interval: float = 30):
+        self.fetch_jwks = fetch_jwks
+        self.algorithms = list(algorithms)
+        self.min_refresh_interval = min_refresh_interval
+        self.keys: Dict[str, Key] = {}
+        self.last_fetch = None
+
+    @classmethod
+    def from_url(cls, url: str, timeout: float = 5, **kwargs) -> "TokenVerifier":
+        def fetch() -> dict:
+            response = httpx.get(url, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+
+        return cls(fetch, **kwargs)
+
+    def reload(self) -> None:
+        now = time.monotonic()
+        if self.last_fetch is not None and now - self.last_fetch < self.min_refresh_interval:
+            return
+        self.last_fetch = now
+        self.keys = {
+            key["kid"]: jwk.construct(key, key.get("alg", self.algorithms[0]))
+            for key in self.fetch_jwks()["keys"]
+        }
+
+    def key(self, kid: Optional[str]) -> Key:
+        key = self.keys.get(kid)
+        if key is None:
+            self.reload()
+            key = self.keys.get(kid)
+        if key is None:
+            raise UnknownKeyError(f"Unknown key id {kid!r}")
+        return key
+
+    def decode(self, token: str, **kwargs) -> dict:
+        kid = jwt.get_unverified_header(token).get("kid")
+        return jwt.decode(token, self.key(kid), algorithms=self.algorithms, **kwargs)
+
+
+def generate(directory: str, kid: Optional[str] = None) -> str:
+    """Write a new P-256 private key to `directory` and return its kid."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    kid = kid or datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    pem = ec.generate_private_key(ec.SECP256R1()).private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{kid}.pem")
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(descriptor, "wb") as key_file:
+        key_file.write(pem)
+    return kid
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4) or sys.argv[1] != "generate":
+        sys.exit("usage: python -m utils.jwks generate <directory> [kid]")
+    print(generate(*sys.argv[2:]))
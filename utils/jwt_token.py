@@ -1,37 +1,283 @@
+import asyncio
+import math
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Union, Any
+from typing import Optional, Tuple, Union, Any
 
 from fastapi import status
 from jose import jwt
 from passlib.context import CryptContext
 
-from utils import exceptions
+from utils import exceptions, metrics
+from utils.jwks import KeyStore, TokenVerifier
+from utils.log import StructuredMessage, logger
 from utils.variables import (ACCESS_TOKEN_EXPIRE_MINUTES, JWT_REFRESH_SECRET_KEY, ALGORITHM, JWT_SECRET_KEY,
-                             REFRESH_TOKEN_EXPIRE_MINUTES)
+                             REFRESH_TOKEN_EXPIRE_MINUTES, HASH_EXECUTOR, HASH_MAX_CONCURRENCY, HASH_WORKERS,
+                             JWT_ACTIVE_KID, JWT_KEYS_DIR, REFRESH_ALGORITHM, ARGON2_MAX_TIME_COST,
+                             ARGON2_MEMORY_KIB, ARGON2_MIN_TIME_COST, ARGON2_PARALLELISM, ARGON2_TIME_COST,
+                             BCRYPT_MAX_ROUNDS, BCRYPT_MIN_ROUNDS, BCRYPT_ROUNDS, PASSWORD_HASH_BUDGET_MS,
+                             PASSWORD_HASH_CALIBRATE, PASSWORD_HASH_SCHEME)
 
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+PASSWORD_SCHEMES = ("argon2", "bcrypt")
+CALIBRATION_PASSWORD = "calibration-password"
 
 
-def get_hashed_password(password: str) -> str:
+def default_password_settings(scheme: str = PASSWORD_HASH_SCHEME) -> dict:
+    if scheme == "argon2":
+        return {"scheme": "argon2", "time_cost": ARGON2_TIME_COST, "memory_cost": ARGON2_MEMORY_KIB,
+                "parallelism": ARGON2_PARALLELISM}
+    return {"scheme": "bcrypt", "rounds": BCRYPT_ROUNDS}
+
+
+def build_password_context(settings: dict) -> CryptContext:
+    """Hash with the configured scheme and cost, anything cheaper or of another scheme needs an update.
+
+    The cost is the policy minimum, so a hash made on a faster node is kept
+    while one below this node's cost gets rehashed on the next login.
+    """
+    scheme = settings["scheme"]
+    schemes = [scheme] + [other for other in PASSWORD_SCHEMES if other != scheme and _has_backend(other)]
+    if scheme == "argon2":
+        options = {
+            "argon2__rounds": settings["time_cost"],
+            "argon2__min_rounds": settings["time_cost"],
+            "argon2__memory_cost": settings["memory_cost"],
+            "argon2__parallelism": settings["parallelism"],
+        }
+    else:
+        options = {
+            "bcrypt__rounds": settings["rounds"],
+            "bcrypt__min_rounds": settings["rounds"],
+            "bcrypt__max_rounds": max(BCRYPT_MAX_ROUNDS, settings["rounds"]),
+        }
+    return CryptContext(schemes=schemes, deprecated=schemes[1:], **options)
+
+
+def _has_backend(scheme: str) -> bool:
+    from passlib import hash as handlers
+    return getattr(handlers, scheme).has_backend()
+
+
+def configure_password_context(settings: dict) -> None:
+    """Also the initializer of process pool workers, which would otherwise hash with the import time cost."""
+    global password_context, password_settings
+    password_settings = settings
+    password_context = build_password_context(settings)
+
+
+def _hash_time(handler, repeat: int = 3) -> float:
+    """Best of `repeat` hashes, the least disturbed by whatever else runs on the machine."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        handler.hash(CALIBRATION_PASSWORD)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def calibrate_bcrypt(budget: float, min_rounds: int = BCRYPT_MIN_ROUNDS, max_rounds: int = BCRYPT_MAX_ROUNDS) -> dict:
+    """Most rounds whose hash fits in `budget` seconds, every extra round doubles the work."""
+    from passlib.hash import bcrypt
+    elapsed = _hash_time(bcrypt.using(rounds=min_rounds))
+    extra_rounds = math.floor(math.log2(budget / elapsed)) if budget > elapsed else 0
+    return {"scheme": "bcrypt", "rounds": min(min_rounds + extra_rounds, max_rounds)}
+
+
+def calibrate_argon2(budget: float, min_time_cost: int = ARGON2_MIN_TIME_COST,
+                     max_time_cost: int = ARGON2_MAX_TIME_COST, memory_cost: int = ARGON2_MEMORY_KIB,
+                     parallelism: int = ARGON2_PARALLELISM) -> dict:
+    """Memory is fixed by configuration, the passes over it scale about linearly and fill the budget."""
+    from passlib.hash import argon2
+    elapsed = _hash_time(argon2.using(time_cost=1, memory_cost=memory_cost, parallelism=parallelism))
+    time_cost = min(max(math.floor(budget / elapsed), min_time_cost), max_time_cost)
+    return {"scheme": "argon2", "time_cost": time_cost, "memory_cost": memory_cost, "parallelism": parallelism}
+
+
+def calibrate(scheme: str = PASSWORD_HASH_SCHEME, budget: float = PASSWORD_HASH_BUDGET_MS / 1000) -> dict:
+    if scheme == "argon2":
+        return calibrate_argon2(budget)
+    return calibrate_bcrypt(budget)
+
+
+password_settings = default_password_settings()
+password_context = build_password_context(password_settings)
+
+# Access tokens signed with a private key carry its kid and can be verified by anyone holding the JWKS.
+ASYMMETRIC_ALGORITHMS = ("ES256",)
+key_store = KeyStore(JWT_KEYS_DIR, algorithm=ALGORITHM, active_kid=JWT_ACTIVE_KID) \
+    if ALGORITHM in ASYMMETRIC_ALGORITHMS else None
+access_token_verifier = TokenVerifier(key_store.jwks, algorithms=[ALGORITHM], min_refresh_interval=1) \
+    if key_store is not None else None
+
+
+class HashingPool:
+    """Runs bcrypt off the event loop, with a cap on how many hashes are in flight."""
+
+    def __init__(self, kind: str = "thread", workers: int = 1, max_concurrency: int = 2,
+                 initializer=None, initargs: tuple = ()):
+        self.kind = kind
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.initializer = initializer
+        self.initargs = initargs
+        self.executor: Optional[Executor] = None
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0
+        self.in_flight = 0
+
+    def get_executor(self) -> Executor:
+        if self.executor is None:
+            if self.kind == "process":
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=self.initializer,
+                                                    initargs=self.initargs)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hashing")
+        return self.executor
+
+    def configure(self, initializer, *initargs) -> None:
+        """Set what new workers run first, running workers are replaced."""
+        self.initializer = initializer
+        self.initargs = initargs
+        self.shutdown()
+
+    @property
+    def queue_depth(self) -> int:
+        """Jobs waiting for the concurrency cap plus jobs waiting for a free worker."""
+        return self.waiting + max(self.in_flight - self.workers, 0)
+
+    async def run(self, func, *args):
+        self.waiting += 1
+        metrics.PASSWORD_HASH_QUEUE_DEPTH.set(self.queue_depth)
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        metrics.PASSWORD_HASH_QUEUE_DEPTH.set(self.queue_depth)
+        try:
+            loop = asyncio.get_running_loop()
+            result, elapsed = await loop.run_in_executor(self.get_executor(), _timed, func, *args)
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+            metrics.PASSWORD_HASH_QUEUE_DEPTH.set(self.queue_depth)
+        metrics.PASSWORD_HASH_DURATION.labels(func.__name__.strip("_")).observe(elapsed)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+        }
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+hashing_pool = HashingPool(kind=HASH_EXECUTOR, workers=HASH_WORKERS, max_concurrency=HASH_MAX_CONCURRENCY,
+                           initializer=configure_password_context, initargs=(password_settings,))
+
+
+async def calibrate_password_hashing() -> dict:
+    """Pick the hash cost for this machine, called from the app startup event before any hashing."""
+    if PASSWORD_HASH_CALIBRATE:
+        settings = await asyncio.to_thread(calibrate)
+    else:
+        settings = default_password_settings()
+    configure_password_context(settings)
+    hashing_pool.configure(configure_password_context, settings)
+    logger.info(StructuredMessage("Password hashing configured", {
+        **settings,
+        "calibrated": PASSWORD_HASH_CALIBRATE,
+        "budget_ms": PASSWORD_HASH_BUDGET_MS,
+    }))
+    return settings
+
+
+def _timed(func, *args):
+    """Run `func` in the worker and time it there, so queueing is not counted as bcrypt time."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def _hash_password(password: str) -> str:
     return password_context.hash(password)
 
 
-def verify_password(password: str, hashed_pass: str) -> None:
-    if not password_context.verify(password, hashed_pass):
+def _password_matches(password: str, hashed_pass: str) -> bool:
+    return password_context.verify(password, hashed_pass)
+
+
+def _password_matches_and_rehash(password: str, hashed_pass: str) -> Tuple[bool, Optional[str]]:
+    """Verify, and when the hash is out of policy return a new one made with the current settings."""
+    return password_context.verify_and_update(password, hashed_pass)
+
+
+def _ensure_password_matches(matches: bool) -> None:
+    if not matches:
         raise exceptions.GenericError(
             message="Invalid password",
             status_code=status.HTTP_401_UNAUTHORIZED
         )
 
 
-def compare_passwords(new_password: str, old_hashed_password: str) -> None:
-    if password_context.verify(new_password, old_hashed_password):
+def _ensure_password_changed(matches: bool) -> None:
+    if matches:
         raise exceptions.GenericError(
             message="New password cannot be current password.",
             status_code=status.HTTP_400_BAD_REQUEST
         )
 
 
+def get_hashed_password(password: str) -> str:
+    return _hash_password(password)
+
+
+def verify_password(password: str, hashed_pass: str) -> None:
+    _ensure_password_matches(_password_matches(password, hashed_pass))
+
+
+def compare_passwords(new_password: str, old_hashed_password: str) -> None:
+    _ensure_password_changed(_password_matches(new_password, old_hashed_password))
+
+
+async def get_hashed_password_async(password: str) -> str:
+    return await hashing_pool.run(_hash_password, password)
+
+
+async def verify_password_async(password: str, hashed_pass: str) -> None:
+    _ensure_password_matches(await hashing_pool.run(_password_matches, password, hashed_pass))
+
+
+async def verify_password_and_rehash_async(password: str, hashed_pass: str) -> Optional[str]:
+    """verify_password_async that also returns the replacement hash of an out of policy hash, None otherwise."""
+    matches, new_hash = await hashing_pool.run(_password_matches_and_rehash, password, hashed_pass)
+    _ensure_password_matches(matches)
+    return new_hash
+
+
+async def compare_passwords_async(new_password: str, old_hashed_password: str) -> None:
+    _ensure_password_changed(await hashing_pool.run(_password_matches, new_password, old_hashed_password))
+
+
+async def verify_password_change_async(current_password: str, new_password: str, hashed_pass: str) -> None:
+    """Run both bcrypt checks of a password change concurrently, reporting errors in the sync order."""
+    current_matches, new_matches = await asyncio.gather(
+        hashing_pool.run(_password_matches, current_password, hashed_pass),
+        hashing_pool.run(_password_matches, new_password, hashed_pass),
+    )
+    _ensure_password_matches(current_matches)
+    _ensure_password_changed(new_matches)
+
+
 def create_access_token(subject: Union[str, Any], expires_delta: int = None) -> str:
     if expires_delta is not None:
         expires_delta = datetime.utcnow() + expires_delta
@@ -39,10 +285,26 @@ def create_access_token(subject: Union[str, Any], expires_delta: int = None) ->
         expires_delta = datetime.utcnow() + timedelta(minutes=int(ACCESS_TOKEN_EXPIRE_MINUTES))
 
     to_encode = {"exp": expires_delta, "sub": str(subject)}
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, ALGORITHM)
+    start = time.perf_counter()
+    if key_store is not None:
+        kid, key = key_store.signing_key()
+        encoded_jwt = jwt.encode(to_encode, key, ALGORITHM, headers={"kid": kid})
+    else:
+        encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, ALGORITHM)
+    metrics.JWT_DURATION.labels("encode").observe(time.perf_counter() - start)
     return encoded_jwt
 
 
+def decode_access_token(token: str) -> dict:
+    start = time.perf_counter()
+    if access_token_verifier is not None:
+        payload = access_token_verifier.decode(token)
+    else:
+        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[ALGORITHM])
+    metrics.JWT_DURATION.labels("decode").observe(time.perf_counter() - start)
+    return payload
+
+
 def create_refresh_token(subject: Union[str, Any], expires_delta: int = None) -> str:
     if expires_delta is not None:
         expires_delta = datetime.utcnow() + expires_delta
@@ -50,10 +312,14 @@ def create_refresh_token(subject: Union[str, Any], expires_delta: int = None) ->
         expires_delta = datetime.utcnow() + timedelta(minutes=int(REFRESH_TOKEN_EXPIRE_MINUTES))
 
     to_encode = {"exp": expires_delta, "sub": str(subject)}
-    encoded_jwt = jwt.encode(to_encode, JWT_REFRESH_SECRET_KEY, ALGORITHM)
+    start = time.perf_counter()
+    encoded_jwt = jwt.encode(to_encode, JWT_REFRESH_SECRET_KEY, REFRESH_ALGORITHM)
+    metrics.JWT_DURATION.labels("encode").observe(time.perf_counter() - start)
     return encoded_jwt
 
 
 def verify_refresh_token(refresh_token: str) -> str:
-    payload = jwt.decode(refresh_token, JWT_REFRESH_SECRET_KEY, algorithms=[ALGORITHM])
+    start = time.perf_counter()
+    payload = jwt.decode(refresh_token, JWT_REFRESH_SECRET_KEY, algorithms=[REFRESH_ALGORITHM])
+    metrics.JWT_DURATION.labels("decode").observe(time.perf_counter() - start)
     return payload.get('sub')
@@ -1,69 +1,177 @@
 import asyncio
+import gzip
+import json
 import logging
 import time
+import zlib
+from collections import deque
 from contextvars import ContextVar
 from typing import Optional
 
 import httpx
 
-from utils.variables import ENV, LOKI_URL
+from utils import metrics
+from utils.variables import (ENV, LOG_CONSOLE_ENABLED, LOG_CONSOLE_LEVEL, LOG_SAMPLE_RATE, LOG_SLOW_REQUEST_MS,
+                             LOKI_BATCH_SIZE, LOKI_FLUSH_INTERVAL, LOKI_MAX_QUEUE_SIZE, LOKI_URL)
 
 # ContextVar to store the trace ID for the current context
 trace_id_var = ContextVar("trace_id", default="")
 
 
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] - %(message)s'
+
+
+class StructuredMessage:
+    """Log message whose fields stay a dict until a handler formats the record.
+
+    Renders as `<prefix>: <fields as JSON>`, the JSON is only built once and
+    only if some handler actually emits the record.
+    """
+
+    __slots__ = ("prefix", "fields", "rendered")
+
+    def __init__(self, prefix: str, fields: dict):
+        self.prefix = prefix
+        self.fields = fields
+        self.rendered = None
+
+    def __str__(self):
+        if self.rendered is None:
+            self.rendered = f"{self.prefix}: {json.dumps(self.fields)}"
+        return self.rendered
+
+
 class CustomFormatter(logging.Formatter):
     def format(self, record):
-        record.trace_id = trace_id_var.get()
-        return super().format(record)
+        # Handlers sharing a format reuse the first handler's output for the record.
+        cache = record.__dict__.setdefault("_formatted", {})
+        key = (self._fmt, self.datefmt)
+        formatted = cache.get(key)
+        if formatted is None:
+            if not hasattr(record, "trace_id"):
+                record.trace_id = trace_id_var.get()
+            formatted = cache[key] = super().format(record)
+        return formatted
+
+
+class LogSampler:
+    """Decides which access log lines are kept.
+
+    Errors, client errors and slow requests are always kept, the other
+    requests are kept at `rate`. The decision is a hash of the trace id,
+    so every line and every service sharing a trace id agree on it.
+    """
+
+    def __init__(self, rate: float = 1.0, slow_threshold: float = 1.0):
+        self.rate = rate
+        self.slow_threshold = slow_threshold
+        self.cutoff = int(rate * 0xFFFFFFFF)
+
+    def keep(self, trace_id: str, status_code: int, process_time: float) -> bool:
+        if self.rate >= 1 or status_code >= 400 or process_time >= self.slow_threshold:
+            return True
+        return zlib.crc32(trace_id.encode()) <= self.cutoff
 
 
 class AsyncLokiHandler(logging.Handler):
-    def __init__(self, url: str, labels: Optional[dict] = None):
+    """Ships records to Loki in gzip compressed batches, one push per label set group.
+
+    Records are formatted when they are emitted and buffered in a bounded
+    deque, the oldest ones are dropped (and counted) once it is full. A
+    single sender task pushes a batch whenever `batch_size` records are
+    buffered or `flush_interval` seconds have passed.
+    """
+
+    def __init__(self, url: str, labels: Optional[dict] = None, batch_size: int = LOKI_BATCH_SIZE,
+                 flush_interval: float = LOKI_FLUSH_INTERVAL, max_queue_size: int = LOKI_MAX_QUEUE_SIZE,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
         super().__init__()
         self.url = url
         self.labels = labels or {}
-        self.queue = asyncio.Queue()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = deque(maxlen=max_queue_size)
+        self.transport = transport
         self.client: Optional[httpx.AsyncClient] = None
         self.task: Optional[asyncio.Task] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.label_sets = {}
+        self.dropped = 0
+        self.sent = 0
         self.last_error_time = 0
         self.error_count = 0
         self.max_backoff = 60  # Maximum backoff time in seconds
 
-    async def initialize(self):
-        if not self.client:
-            self.client = httpx.AsyncClient()
-        if not self.task:
-            self.task = asyncio.create_task(self.sender())
+    async def start(self):
+        if self.task is None and self.url:
+            self.loop = asyncio.get_running_loop()
+            self.wakeup = asyncio.Event()
+            self.client = httpx.AsyncClient(transport=self.transport)
+            self.task = self.loop.create_task(self.sender())
 
     async def sender(self):
         while True:
-            record = await self.queue.get()
             try:
-                await self.send_log(record)
-                self.error_count = 0  # Reset error count on successful send
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.send_pending()
+
+    async def send_pending(self, retry: bool = True):
+        while self.buffer:
+            batch = self.take_batch()
+            try:
+                await self.send_batch(batch)
+            except asyncio.CancelledError:
+                # Shutdown cancelled the push, aclose() sends the batch again.
+                self.requeue(batch)
+                raise
             except Exception as e:
-                self.handle_error(e)
-            finally:
-                self.queue.task_done()
-
-    async def send_log(self, record):
-        if not self.client:
-            await self.initialize()
-        log_entry = self.format(record)
+                self.requeue(batch)
+                if not retry:
+                    return
+                # Stay in the sender so nothing is pushed before the backoff is over.
+                await asyncio.sleep(self.handle_error(e))
+                return
+            self.error_count = 0  # Reset error count on successful send
+            self.sent += len(batch)
+
+    def take_batch(self) -> list:
+        batch = []
+        while self.buffer and len(batch) < self.batch_size:
+            batch.append(self.buffer.popleft())
+        metrics.LOKI_QUEUE_DEPTH.set(len(self.buffer))
+        return batch
+
+    def requeue(self, batch: list):
+        """Put a failed batch back in front, dropping its oldest records if newer ones filled the buffer."""
+        room = self.buffer.maxlen - len(self.buffer)
+        keep = batch[-room:] if room > 0 else []
+        self.dropped += len(batch) - len(keep)
+        metrics.LOKI_DROPPED.inc(len(batch) - len(keep))
+        self.buffer.extendleft(reversed(keep))
+        metrics.LOKI_QUEUE_DEPTH.set(len(self.buffer))
+
+    def build_payload(self, batch: list) -> bytes:
+        streams = {}
+        for labels, timestamp, line in batch:
+            streams.setdefault(labels, []).append([timestamp, line])
         payload = {
             "streams": [
-                {
-                    "stream": self.labels,
-                    "values": [[str(int(record.created * 1e9)), log_entry]]
-                }
+                {"stream": dict(labels), "values": values}
+                for labels, values in streams.items()
             ]
         }
-        headers = {'Content-type': 'application/json'}
-        response = await self.client.post(self.url, json=payload, headers=headers)
+        return gzip.compress(json.dumps(payload).encode())
+
+    async def send_batch(self, batch: list):
+        headers = {'Content-type': 'application/json', 'Content-Encoding': 'gzip'}
+        response = await self.client.post(self.url, content=self.build_payload(batch), headers=headers)
         response.raise_for_status()
 
-    def handle_error(self, error):
+    def handle_error(self, error) -> float:
         current_time = time.time()
         if current_time - self.last_error_time > self.max_backoff:
             self.error_count = 0
@@ -74,28 +182,45 @@ class AsyncLokiHandler(logging.Handler):
 
         # Log the error to console, but don't try to send it to Loki
         print(f"Failed to send log to Loki: {error}. Backing off for {backoff_time} seconds.")
-        asyncio.create_task(self.backoff(backoff_time))
+        return backoff_time
 
-    async def backoff(self, seconds):
-        await asyncio.sleep(seconds)
+    def stream_labels(self, record) -> tuple:
+        labels = self.label_sets.get(record.levelname)
+        if labels is None:
+            labels = tuple(sorted({**self.labels, "level": record.levelname.lower()}.items()))
+            self.label_sets[record.levelname] = labels
+        return labels
 
     def emit(self, record):
-        asyncio.create_task(self.async_emit(record))
-
-    async def async_emit(self, record):
-        if not self.client:
-            await self.initialize()
-        await self.queue.put(record)
-
-    async def close(self):
+        if not self.url:
+            return
+        try:
+            entry = (self.stream_labels(record), str(int(record.created * 1e9)), self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+            metrics.LOKI_DROPPED.inc()
+        self.buffer.append(entry)
+        metrics.LOKI_QUEUE_DEPTH.set(len(self.buffer))
+        if len(self.buffer) >= self.batch_size and self.wakeup is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def stats(self) -> dict:
+        return {"queue_depth": len(self.buffer), "dropped": self.dropped, "sent": self.sent}
+
+    async def aclose(self):
         if self.task:
             self.task.cancel()
             try:
                 await self.task
             except asyncio.CancelledError:
                 pass
-        await self.queue.join()
+            self.task = None
         if self.client:
+            await self.send_pending(retry=False)
             await self.client.aclose()
             self.client = None
 
@@ -118,7 +243,17 @@ class AsyncLogger(logging.Logger):
 
         # Use async handlers separately
         for handler in self._async_handlers:
-            handler.emit(record)
+            handler.handle(record)
+
+    async def start(self):
+        """Start the background senders, called from the app startup event."""
+        for handler in self._async_handlers:
+            await handler.start()
+
+    async def aclose(self):
+        """Flush whatever is still buffered and stop the senders."""
+        for handler in self._async_handlers:
+            await handler.aclose()
 
 
 logging.setLoggerClass(AsyncLogger)
@@ -129,11 +264,14 @@ def get_logger(name: str) -> AsyncLogger:
     logger.setLevel(logging.DEBUG)
 
     if not logger.handlers:
+        formatter = CustomFormatter(LOG_FORMAT)
+
         # Console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG)
-        console_formatter = CustomFormatter('%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] - %(message)s')
-        console_handler.setFormatter(console_formatter)
+        if LOG_CONSOLE_ENABLED:
+            console_handler = logging.StreamHandler()
+            console_handler.setLevel(LOG_CONSOLE_LEVEL)
+            console_handler.setFormatter(formatter)
+            logger.addHandler(console_handler)
 
         # Loki handler
         loki_handler = AsyncLokiHandler(
@@ -141,11 +279,7 @@ def get_logger(name: str) -> AsyncLogger:
             labels={"service": "login-auth", "env": ENV}
         )
         loki_handler.setLevel(logging.DEBUG)
-        loki_formatter = CustomFormatter('%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] - %(message)s')
-        loki_handler.setFormatter(loki_formatter)
-
-        # Add handlers to logger
-        logger.addHandler(console_handler)
+        loki_handler.setFormatter(formatter)
         logger.addHandler(loki_handler)
 
     return logger
@@ -153,3 +287,4 @@ def get_logger(name: str) -> AsyncLogger:
 
 # Create a global logger instance
 logger = get_logger("auth_and_order_service")
+access_log_sampler = LogSampler(rate=LOG_SAMPLE_RATE, slow_threshold=LOG_SLOW_REQUEST_MS / 1000)
@@ -0,0 +1,396 @@
+"""In process metrics registry, exposed in the prometheus text format at /metrics.
+
+Every child metric (a metric plus one set of label values) allocates its
+slots once, a histogram child all of its buckets at the same time, so the
+hot path is a dict lookup and a few float additions, without locks in a
+single process.
+
+With METRICS_MULTIPROC_DIR set, each worker process keeps its values in its
+own mmap backed file in that directory and a scrape merges all of them, so
+the numbers add up whichever uvicorn worker answers. Gauges of workers that
+are no longer alive are left out of the merge. Every write to the file
+takes a per process lock, held otherwise only while the file grows, so no
+thread writes to a map that is being replaced.
+"""
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from typing import Dict, Iterable, Optional, Tuple
+
+from utils.variables import METRICS_MULTIPROC_DIR
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_length = struct.Struct("i")
+_double = struct.Struct("d")
+
+
+class MemoryStorage:
+    """Values of a single process, kept in a plain list."""
+
+    def __init__(self):
+        self.keys = []
+        self.values = []
+        self.lock = threading.Lock()
+
+    def slot(self, key: str) -> int:
+        with self.lock:
+            self.keys.append(key)
+            self.values.append(0.0)
+            return len(self.values) - 1
+
+    def add(self, slot: int, amount: float) -> None:
+        self.values[slot] += amount
+
+    def set(self, slot: int, value: float) -> None:
+        self.values[slot] = value
+
+    def items(self) -> Iterable[Tuple[str, float]]:
+        return list(zip(self.keys, self.values))
+
+
+class MmapStorage:
+    """Append only file of (key, float64) entries, written by one process and read by any.
+
+    Layout: a 8 byte header holding the used size, then entries made of the
+    key length, the utf-8 key padded to 8 bytes and the value.
+    """
+
+    header_size = 8
+
+    def __init__(self, path: str, initial_size: int = 1 << 20):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a+b")
+        if os.fstat(self.file.fileno()).st_size < initial_size:
+            self.file.truncate(initial_size)
+        self.capacity = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.capacity)
+        self.used = _length.unpack_from(self.map, 0)[0] or self.header_size
+        self.positions = {key: offset for key, offset, _ in read_entries(self.map, self.used)}
+
+    def slot(self, key: str) -> int:
+        with self.lock:
+            offset = self.positions.get(key)
+            if offset is None:
+                offset = self.append(key)
+            return offset
+
+    def append(self, key: str) -> int:
+        encoded = key.encode()
+        padding = (8 - (_length.size + len(encoded)) % 8) % 8
+        value_offset = self.used + _length.size + len(encoded) + padding
+        entry_end = value_offset + _double.size
+        if entry_end > self.capacity:
+            self.grow(entry_end)
+
+        _length.pack_into(self.map, self.used, len(encoded))
+        self.map[self.used + _length.size:self.used + _length.size + len(encoded)] = encoded
+        _double.pack_into(self.map, value_offset, 0.0)
+        # Publish the entry only once it is complete, readers stop at `used`.
+        self.used = entry_end
+        _length.pack_into(self.map, 0, self.used)
+        self.positions[key] = value_offset
+        return value_offset
+
+    def grow(self, needed: int) -> None:
+        """Called from append() with the lock held."""
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        self.map.close()
+        self.file.truncate(capacity)
+        self.capacity = capacity
+        self.map = mmap.mmap(self.file.fileno(), self.capacity)
+
+    # Writes take the lock that grow() holds while it remaps, threads must never see a closed map.
+    def add(self, slot: int, amount: float) -> None:
+        with self.lock:
+            _double.pack_into(self.map, slot, _double.unpack_from(self.map, slot)[0] + amount)
+
+    def set(self, slot: int, value: float) -> None:
+        with self.lock:
+            _double.pack_into(self.map, slot, value)
+
+    def items(self) -> Iterable[Tuple[str, float]]:
+        with self.lock:
+            return [(key, value) for key, _, value in read_entries(self.map, self.used)]
+
+    def close(self) -> None:
+        with self.lock:
+            self.map.close()
+            self.file.close()
+
+
+def read_entries(buffer, used: int):
+    offset = MmapStorage.header_size
+    while offset < used:
+        length = _length.unpack_from(buffer, offset)[0]
+        key = bytes(buffer[offset + _length.size:offset + _length.size + length]).decode()
+        padding = (8 - (_length.size + length) % 8) % 8
+        value_offset = offset + _length.size + length + padding
+        yield key, value_offset, _double.unpack_from(buffer, value_offset)[0]
+        offset = value_offset + _double.size
+
+
+def read_file(path: str) -> Iterable[Tuple[str, float]]:
+    with open(path, "rb") as file:
+        data = file.read()
+    if len(data) < MmapStorage.header_size:
+        return []
+    return [(key, value) for key, _, value in read_entries(data, _length.unpack_from(data, 0)[0])]
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def sample_key(name: str, sample: str, labels: Dict[str, str]) -> str:
+    return json.dumps([name, sample, labels], separators=(",", ":"))
+
+
+class CounterChild:
+    __slots__ = ("storage", "slot")
+
+    def __init__(self, storage, name, labels):
+        self.storage = storage
+        self.slot = storage.slot(sample_key(name, name, labels))
+
+    def inc(self, amount: float = 1) -> None:
+        self.storage.add(self.slot, amount)
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        self.storage.set(self.slot, value)
+
+    def dec(self, amount: float = 1) -> None:
+        self.storage.add(self.slot, -amount)
+
+
+class HistogramChild:
+    __slots__ = ("storage", "buckets", "bucket_slots", "sum_slot", "count_slot")
+
+    def __init__(self, storage, name, labels, buckets):
+        self.storage = storage
+        self.buckets = buckets
+        self.bucket_slots = [
+            storage.slot(sample_key(name, f"{name}_bucket", {**labels, "le": format_value(bound)}))
+            for bound in buckets + (float("inf"),)
+        ]
+        self.sum_slot = storage.slot(sample_key(name, f"{name}_sum", labels))
+        self.count_slot = storage.slot(sample_key(name, f"{name}_count", labels))
+
+    def observe(self, value: float) -> None:
+        # Buckets are stored per bound and made cumulative when rendered.
+        self.storage.add(self.bucket_slots[bisect_left(self.buckets, value)], 1)
+        self.storage.add(self.sum_slot, value)
+        self.storage.add(self.count_slot, 1)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            labels = dict(zip(self.labelnames, (str(value) for value in values)))
+            child = self.children[values] = self.make_child(self.registry.storage, labels)
+        return child
+
+    def make_child(self, storage, labels):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def make_child(self, storage, labels):
+        return CounterChild(storage, self.name, labels)
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def make_child(self, storage, labels):
+        return GaugeChild(storage, self.name, labels)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def make_child(self, storage, labels):
+        return HistogramChild(storage, self.name, labels, self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+
+class Registry:
+    def __init__(self, multiproc_dir: Optional[str] = None):
+        self.multiproc_dir = multiproc_dir
+        self.metrics: Dict[str, Metric] = {}
+        self.storage = None
+        self.open_storage()
+
+    def open_storage(self) -> None:
+        """(Re)open this process' storage, forked workers must not share the parent's."""
+        if self.multiproc_dir:
+            os.makedirs(self.multiproc_dir, exist_ok=True)
+            self.storage = MmapStorage(os.path.join(self.multiproc_dir, f"{os.getpid()}.db"))
+        else:
+            self.storage = MemoryStorage()
+        for metric in self.metrics.values():
+            metric.children.clear()
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self.register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self.register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def collect(self) -> Dict[str, float]:
+        """Sample values by key, summed over every worker in multiprocess mode."""
+        if not self.multiproc_dir:
+            return dict(self.storage.items())
+
+        values = {}
+        for path in glob.glob(os.path.join(self.multiproc_dir, "*.db")):
+            alive = pid_alive(int(os.path.basename(path)[:-3]))
+            for key, value in read_file(path):
+                metric = self.metrics.get(json.loads(key)[0])
+                if metric is not None and metric.kind == "gauge" and not alive:
+                    continue
+                values[key] = values.get(key, 0.0) + value
+        return values
+
+    def render(self) -> bytes:
+        samples = {}
+        for key, value in self.collect().items():
+            name, sample, labels = json.loads(key)
+            samples.setdefault(name, []).append((sample, labels, value))
+
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            metric_samples = samples.get(name, [])
+            if metric.kind == "histogram":
+                metric_samples = cumulative_buckets(name, metric_samples)
+            for sample, labels, value in metric_samples:
+                lines.append(f"{sample}{format_labels(labels)} {format_value(value)}")
+        return ("\n".join(lines) + "\n").encode()
+
+
+def cumulative_buckets(name: str, samples: list) -> list:
+    buckets, others = {}, []
+    for sample, labels, value in samples:
+        if sample == f"{name}_bucket":
+            series = tuple(sorted((k, v) for k, v in labels.items() if k != "le"))
+            buckets.setdefault(series, []).append((float(labels["le"]), labels, value))
+        else:
+            others.append((sample, labels, value))
+
+    rendered = []
+    for series in buckets.values():
+        running = 0.0
+        for _, labels, value in sorted(series, key=lambda item: item[0]):
+            running += value
+            rendered.append((f"{name}_bucket", labels, running))
+    return rendered + others
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + "}"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return f"{value:.1f}"
+    return repr(float(value))
+
+
+registry = Registry(multiproc_dir=METRICS_MULTIPROC_DIR)
+# Forked workers must not write to the parent's storage. Only the global registry is reopened in children.
+os.register_at_fork(after_in_child=registry.open_storage)
+
+HTTP_REQUESTS = registry.counter(
+    "http_requests_total", "HTTP requests by route and status code.", ("method", "route", "status"))
+HTTP_REQUEST_DURATION = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route.", ("method", "route"))
+PASSWORD_HASH_DURATION = registry.histogram(
+    "password_hash_duration_seconds", "Time spent in bcrypt, per operation.", ("operation",))
+PASSWORD_HASH_QUEUE_DEPTH = registry.gauge(
+    "password_hash_queue_depth", "Hashing jobs waiting for a worker.")
+JWT_DURATION = registry.histogram(
+    "jwt_duration_seconds", "Time spent encoding and decoding JWTs.", ("operation",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025))
+REDIS_OTP_DURATION = registry.histogram(
+    "redis_otp_duration_seconds", "Redis round trip time of OTP operations.", ("operation",))
+DB_POOL_WAIT = registry.histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a pooled database connection.", ("pool",))
+DB_POOL_TIMEOUTS = registry.counter(
+    "db_pool_timeouts_total", "Database connection checkouts that timed out.", ("pool",))
+ACCESS_LOGS_SAMPLED_OUT = registry.counter(
+    "access_logs_sampled_out_total", "Request log lines skipped by LOG_SAMPLE_RATE.")
+OUTBOX_PUBLISHED = registry.counter(
+    "outbox_published_total", "Outbox messages confirmed by the broker.", ("queue",))
+OUTBOX_FAILURES = registry.counter(
+    "outbox_failures_total", "Outbox messages whose publish attempt failed.")
+LOKI_QUEUE_DEPTH = registry.gauge(
+    "loki_queue_depth", "Log records buffered for Loki.")
+LOKI_DROPPED = registry.counter(
+    "loki_dropped_records_total", "Log records dropped because the Loki buffer was full.")
+EVENT_LOOP_LAG = registry.histogram(
+    "event_loop_lag_seconds", "How late the watchdog ticker woke up.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+EVENT_LOOP_STALLS = registry.counter(
+    "event_loop_stalls_total", "Event loop stalls over the watchdog threshold, by call site.", ("site",))
+ADMISSION_SHED = registry.counter(
+    "admission_shed_total", "Login attempts refused before hashing, by limit and backend.", ("scope", "backend"))
+ADMISSION_FALLBACKS = registry.counter(
+    "admission_fallbacks_total", "Admission checks decided by local buckets because Redis did not answer in time.")
+IDEMPOTENT_REPLAYS = registry.counter(
+    "idempotent_replays_total", "Responses served again for a repeated Idempotency-Key.", ("path",))
@@ -1,11 +1,14 @@
-import json
+import re
 import time
 import uuid
-from typing import Callable
+from typing import Optional
 
-from fastapi import Request, Response
-
-from utils.log import logger, trace_id_var
+from utils import cache, helpers, metrics
+from utils.database import RequestDatabaseStats, db_stats_var, db_sticky_key_var
+from utils.log import StructuredMessage, access_log_sampler, logger, trace_id_var
+from utils.profiler import profiler
+from utils.variables import DB_REPLICA_STICKY_BY_IP, LOG_BODY_MAX_BYTES
+from utils.watchdog import watchdog
 
 # List of sensitive fields to redact
 SENSITIVE_FIELDS = [
@@ -13,66 +16,149 @@ SENSITIVE_FIELDS = [
     "access_token", "refresh_token"
 ]
 
-
-def sanitize_payload(payload):
-    if isinstance(payload, str):
+# `"<sensitive field>": <value>`, the value being a (possibly truncated) JSON string or a bare literal.
+SENSITIVE_PATTERN = re.compile(
+    rb'("(?:' + b"|".join(re.escape(field.encode()) for field in SENSITIVE_FIELDS) + rb')"\s*:\s*)'
+    rb'(?:"(?:[^"\\]|\\.)*(?:"|\\?\Z)|[^,}\]\s]+)'
+)
+
+
+# Client supplied trace ids end up in log labels and the outbox table, anything else is replaced.
+TRACE_ID_PATTERN = re.compile(rb"[A-Za-z0-9._:-]{1,64}")
+
+
+def request_trace_id(headers: dict) -> str:
+    trace_id = headers.get(b"x-trace-id", b"")
+    if TRACE_ID_PATTERN.fullmatch(trace_id):
+        return trace_id.decode()
+    return str(uuid.uuid4())
+
+
+def sticky_key(scope, headers: dict) -> Optional[str]:
+    """Who a request is for read-your-writes: a digest of its bearer token, else its client address.
+
+    The address is only meaningful when scope["client"] is the real client,
+    which behind a proxy needs uvicorn's --proxy-headers and
+    --forwarded-allow-ips. Otherwise every anonymous client shares the proxy's
+    address and one write pins all of them to the primary, so set
+    DB_REPLICA_STICKY_BY_IP=false there.
+    """
+    authorization = headers.get(b"authorization")
+    if authorization:
+        return f"token:{cache.token_digest(authorization.decode(errors='replace'))}"
+    if DB_REPLICA_STICKY_BY_IP and scope.get("client"):
+        return f"ip:{scope['client'][0]}"
+    return None
+
+
+def redact(body: bytes) -> str:
+    """Mask the values of SENSITIVE_FIELDS in one pass over the raw body, without parsing it."""
+    return SENSITIVE_PATTERN.sub(rb'\1"******"', body).decode(errors="replace")
+
+
+def observe_request(scope, status_code: int, seconds: float) -> None:
+    """Record the request under its route template, unmatched paths share one label to bound cardinality."""
+    route = scope.get("route")
+    path = getattr(route, "path", "unmatched")
+    metrics.HTTP_REQUESTS.labels(scope["method"], path, status_code).inc()
+    metrics.HTTP_REQUEST_DURATION.labels(scope["method"], path).observe(seconds)
+
+
+class LoggingMiddleware:
+    """Pure ASGI request logger.
+
+    The request body is teed while the app reads it, keeping at most
+    `max_body_size` bytes for the log, and the log line is only built
+    once the response has been sent.
+    """
+
+    def __init__(self, app, max_body_size: int = LOG_BODY_MAX_BYTES):
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        trace_id = request_trace_id(headers)
+        # X-Profile samples this request's task, the profile is kept under the trace id it is returned with.
+        profiling = b"x-profile" in headers and helpers.internal_token_matches(
+            headers.get(b"x-internal-token", b"").decode())
+        trace_id_var.set(trace_id)
+        watchdog.track(trace_id)
+        db_stats = RequestDatabaseStats()
+        db_stats_var.set(db_stats)
+        # Reads after a write of the same client go to the primary, see RoutingSession.
+        db_sticky_key_var.set(sticky_key(scope, headers))
+
+        start_time = time.perf_counter()
+        body = bytearray()
+        truncated = False
+        status_code = 500
+
+        async def receive_wrapper():
+            nonlocal truncated
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                room = self.max_body_size - len(body)
+                if len(chunk) > room:
+                    truncated = True
+                if room > 0:
+                    body.extend(chunk[:room])
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if profiling:
+                    message.setdefault("headers", []).append((b"x-trace-id", trace_id.encode()))
+            await send(message)
+
+        log_dict = {
+            "url": scope["path"],
+            "method": scope["method"],
+            "trace_id": trace_id,
+            "client_ip": scope["client"][0] if scope.get("client") else None,
+        }
+
+        if profiling:
+            profiler.start_request()
         try:
-            payload = json.loads(payload)
-        except json.JSONDecodeError:
-            return payload
-
-    if isinstance(payload, dict):
-        return {k: "******" if k in SENSITIVE_FIELDS else sanitize_payload(v) for k, v in payload.items()}
-    elif isinstance(payload, list):
-        return [sanitize_payload(item) for item in payload]
-    return payload
-
-
-async def optimized_logging_middleware(request: Request, call_next: Callable) -> Response:
-    trace_id = request.headers.get("X-Trace-ID", str(uuid.uuid4()))
-    trace_id_var.set(trace_id)
-
-    start_time = time.time()
-    client_ip = request.client.host
-
-    # Get and redact the request body
-    try:
-        request_body = await request.json()
-    except json.JSONDecodeError:
-        request_body = (await request.body()).decode() or ""
-
-    sanitized_body = sanitize_payload(request_body)
-
-    log_dict = {
-        "url": request.url.path,
-        "method": request.method,
-        "trace_id": trace_id,
-        "client_ip": client_ip,
-        "request_payload": sanitized_body
-    }
-
-    try:
-        response = await call_next(request)
-        process_time = time.time() - start_time
-        status_code = response.status_code
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except Exception as e:
+            observe_request(scope, 500, time.perf_counter() - start_time)
+            # Log the exception and re-raise it to be handled by global exception handlers
+            log_dict["request_payload"] = redact(bytes(body))
+            logger.exception("Unhandled exception during request processing", extra=log_dict)
+            raise e
+        finally:
+            if profiling:
+                profiler.finish_request(trace_id)
+
+        process_time = time.perf_counter() - start_time
+        observe_request(scope, status_code, process_time)
+        if not access_log_sampler.keep(trace_id, status_code, process_time):
+            metrics.ACCESS_LOGS_SAMPLED_OUT.inc()
+            return
 
         log_dict.update({
+            "request_payload": redact(bytes(body)),
             "process_time": f"{process_time:.4f}",
-            "status_code": status_code
+            "status_code": status_code,
+            **db_stats.as_log_dict()
         })
-
-        log_message = json.dumps(log_dict)
+        if truncated:
+            log_dict["request_payload_truncated"] = True
+        if profiling:
+            log_dict["profiled"] = True
 
         if status_code >= 500:
-            logger.error(f"Request failed: {log_message}")
+            logger.error(StructuredMessage("Request failed", log_dict))
         elif status_code >= 400:
-            logger.warning(f"Request resulted in client error: {log_message}")
+            logger.warning(StructuredMessage("Request resulted in client error", log_dict))
         else:
-            logger.info(f"Request completed successfully: {log_message}")
-
-        return response
-
-    except Exception as e:
-        # Log the exception and re-raise it to be handled by global exception handlers
-        logger.exception("Unhandled exception during request processing", extra=log_dict)
-        raise e
+            logger.info(StructuredMessage("Request completed successfully", log_dict))
@@ -1,27 +1,65 @@
 import random
+import time
 
-import redis
-
+from utils import metrics, redis_client
 from utils.exceptions import GenericError
-from utils.variables import REDIS_SERVER
+from utils.variables import OTP_RATE_LIMIT, OTP_RATE_WINDOW
+
+# Counts the issue against the per email window and stores the OTP, unless the limit is already reached.
+ISSUE_SCRIPT = """
+local issued = redis.call('INCR', KEYS[2])
+if issued == 1 then
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+if issued > tonumber(ARGV[4]) then
+    return -1
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return issued
+"""
+
+# Compare and delete, so a wrong guess does not consume the OTP.
+VERIFY_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return 1
+end
+return 0
+"""
 
 
 class OTPService:
-    def __init__(self, redis_url, expiry_seconds=600):
-        self.redis = redis.from_url(redis_url)
+    def __init__(self, client, expiry_seconds=600, rate_limit=OTP_RATE_LIMIT, rate_window=OTP_RATE_WINDOW):
+        self.redis = client
         self.expiry_seconds = expiry_seconds
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.issue_script = client.register_script(ISSUE_SCRIPT)
+        self.verify_script = client.register_script(VERIFY_SCRIPT)
 
-    def generate_otp(self, user_email):
+    async def generate_otp(self, user_email):
         otp = str(random.randint(1000, 9999))
-        key = f"otp:{user_email}"
-        self.redis.setex(key, self.expiry_seconds, otp)
+        # Lowercased like the email lookups, so the address as typed and as stored share one OTP.
+        user_email = user_email.lower()
+        keys = [f"otp:{user_email}", f"otp:rate:{user_email}"]
+        start = time.perf_counter()
+        issued = await self.issue_script(
+            keys=keys,
+            args=[otp, self.expiry_seconds, self.rate_window, self.rate_limit]
+        )
+        metrics.REDIS_OTP_DURATION.labels("issue").observe(time.perf_counter() - start)
+        if issued < 0:
+            raise GenericError(
+                message="Too many OTP requests. Please try again later.",
+                status_code=429,
+            )
         return otp
 
-    def verify_otp(self, user_email, otp):
-        key = f"otp:{user_email}"
-        stored_otp = self.redis.get(key)
-        if stored_otp and stored_otp.decode() == str(otp):
-            self.redis.delete(key)
+    async def verify_otp(self, user_email, otp):
+        start = time.perf_counter()
+        verified = await self.verify_script(keys=[f"otp:{user_email.lower()}"], args=[str(otp)])
+        metrics.REDIS_OTP_DURATION.labels("verify").observe(time.perf_counter() - start)
+        if verified:
             return True
         raise GenericError(
             message="OTP verification failed. Please try again.",
@@ -29,4 +67,4 @@ class OTPService:
         )
 
 
-otp = OTPService(redis_url=REDIS_SERVER)
+otp = OTPService(client=redis_client.client)
@@ -0,0 +1,108 @@
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from utils import metrics
+
+# Upper bounds (in seconds) of the checkout wait time histogram buckets.
+WAIT_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class PoolStats:
+    """Checkout counters and a wait time histogram for a connection pool."""
+
+    def __init__(self, buckets=WAIT_TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def observe_wait(self, seconds: float) -> None:
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.checkouts += 1
+            self.wait_time_total += seconds
+            if seconds > self.wait_time_max:
+                self.wait_time_max = seconds
+
+    def observe_timeout(self) -> None:
+        with self._lock:
+            self.timeouts += 1
+
+    def histogram(self) -> list:
+        """Cumulative bucket counts, the same shape prometheus uses."""
+        with self._lock:
+            counts = list(self.bucket_counts)
+        histogram, running = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            running += count
+            histogram.append({"le": bound, "count": running})
+        return histogram
+
+    def as_dict(self) -> dict:
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_time_total": round(self.wait_time_total, 6),
+            "wait_time_max": round(self.wait_time_max, 6),
+            "wait_time_histogram": self.histogram(),
+        }
+
+
+class InstrumentedPoolMixin:
+    """Records how long every checkout of a queue pool waited for a connection."""
+
+    metrics_label = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.observe_timeout()
+            metrics.DB_POOL_TIMEOUTS.labels(self.metrics_label).inc()
+            raise
+        wait = time.perf_counter() - start
+        self.stats.observe_wait(wait)
+        metrics.DB_POOL_WAIT.labels(self.metrics_label).observe(wait)
+        return connection
+
+    def recreate(self):
+        # engine.dispose() swaps in a recreated pool, keep the history with it.
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def status_dict(self) -> dict:
+        return {
+            "size": self.size(),
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": max(self.overflow(), 0),
+            "max_overflow": self._max_overflow,
+            "timeout": self._timeout,
+            **self.stats.as_dict(),
+        }
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    """QueuePool for the synchronous psycopg2 engine."""
+
+    metrics_label = "sync"
+
+
+class InstrumentedAsyncQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool for the asyncpg engine."""
+
+    metrics_label = "async"
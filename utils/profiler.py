@@ -0,0 +1,224 @@
+import asyncio
+import itertools
+import os
+import sys
+import sysconfig
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from typing import Optional
+
+from fastapi import status
+
+from utils import exceptions
+from utils.variables import (PROFILE_INTERVAL_MS, PROFILE_MAX_REQUEST_PROFILES, PROFILE_MAX_SNAPSHOTS,
+                             TRACEMALLOC_FRAMES)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STDLIB = sysconfig.get_paths()["stdlib"]
+
+
+def frame_name(frame) -> str:
+    filename = frame.f_code.co_filename
+    if filename.startswith(PROJECT_ROOT):
+        filename = os.path.relpath(filename, PROJECT_ROOT)
+    elif "site-packages" in filename:
+        filename = filename.rsplit("site-packages" + os.sep, 1)[1]
+    elif filename.startswith(STDLIB):
+        filename = os.path.relpath(filename, STDLIB)
+    return f"{filename}:{frame.f_code.co_name}"
+
+
+def collapse(frame) -> str:
+    """Root first, `;` separated stack of a frame, the collapsed format flamegraph.pl and speedscope read."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profile:
+    def __init__(self):
+        self.samples = Counter()
+        self.started = time.monotonic()
+        self.duration = 0.0
+
+    def add(self, stack: str) -> None:
+        self.samples[stack] += 1
+
+    def finish(self) -> "Profile":
+        self.duration = time.monotonic() - self.started
+        return self
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class SamplingProfiler:
+    """Statistical CPU profiler driven by one background thread.
+
+    A process wide profile samples the stack of every thread for a fixed
+    time. Request profiles only sample the event loop thread while the
+    request's own task is the one running, so concurrent requests do not
+    leak into each other's profile. The thread exits when nothing is being
+    profiled.
+    """
+
+    def __init__(self, interval: float = 0.005, max_request_profiles: int = 100):
+        self.interval = interval
+        self.max_request_profiles = max_request_profiles
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.process_profile: Optional[Profile] = None
+        self.task_profiles = {}
+        # Finished request profiles by trace id, oldest evicted first.
+        self.request_profiles = OrderedDict()
+
+    def ensure_sampling(self) -> None:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.sample, name="profiler", daemon=True)
+                self.thread.start()
+
+    def sample(self) -> None:
+        own_id = threading.get_ident()
+        while True:
+            with self.lock:
+                if self.process_profile is None and not self.task_profiles:
+                    self.thread = None
+                    return
+            frames = sys._current_frames()
+
+            process_profile = self.process_profile
+            if process_profile is not None:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in frames.items():
+                    if thread_id != own_id:
+                        process_profile.add(f"{names.get(thread_id, thread_id)};{collapse(frame)}")
+
+            if self.task_profiles and self.loop_thread_id in frames:
+                task_profile = self.task_profiles.get(asyncio.current_task(self.loop))
+                if task_profile is not None:
+                    task_profile.add(collapse(frames[self.loop_thread_id]))
+
+            time.sleep(self.interval)
+
+    async def profile(self, seconds: float) -> Profile:
+        if self.process_profile is not None:
+            raise exceptions.GenericError(
+                message="A profile is already running.",
+                status_code=status.HTTP_409_CONFLICT
+            )
+        self.process_profile = profile = Profile()
+        self.ensure_sampling()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.process_profile = None
+        return profile.finish()
+
+    def start_request(self) -> None:
+        """Start profiling the current task, it has to run on the event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.task_profiles[asyncio.current_task()] = Profile()
+        self.ensure_sampling()
+
+    def finish_request(self, trace_id: str) -> Profile:
+        profile = self.task_profiles.pop(asyncio.current_task()).finish()
+        self.request_profiles[trace_id] = profile
+        while len(self.request_profiles) > self.max_request_profiles:
+            self.request_profiles.popitem(last=False)
+        return profile
+
+    def request_profile(self, trace_id: str) -> Profile:
+        profile = self.request_profiles.get(trace_id)
+        if profile is None:
+            raise exceptions.GenericError(
+                message="No profile recorded for this trace id.",
+                status_code=status.HTTP_404_NOT_FOUND
+            )
+        return profile
+
+
+class MemorySnapshots:
+    """tracemalloc snapshots kept by id so any two can be diffed.
+
+    Tracing starts with the first snapshot and costs memory and CPU until
+    stop() is called.
+    """
+
+    def __init__(self, frames: int = 1, max_snapshots: int = 10):
+        self.frames = frames
+        self.max_snapshots = max_snapshots
+        self.snapshots = OrderedDict()
+        self.ids = itertools.count(1)
+
+    def take(self, limit: int = 25) -> dict:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        snapshot_id = next(self.ids)
+        self.snapshots[snapshot_id] = snapshot
+        while len(self.snapshots) > self.max_snapshots:
+            self.snapshots.popitem(last=False)
+
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "id": snapshot_id,
+            "traced_memory": current,
+            "traced_memory_peak": peak,
+            "top": [
+                {"location": location(stat.traceback), "size": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:limit]
+            ],
+        }
+
+    def get(self, snapshot_id: int) -> tracemalloc.Snapshot:
+        snapshot = self.snapshots.get(snapshot_id)
+        if snapshot is None:
+            raise exceptions.GenericError(
+                message=f"Snapshot {snapshot_id} does not exist.",
+                status_code=status.HTTP_404_NOT_FOUND
+            )
+        return snapshot
+
+    def diff(self, start_id: int, end_id: int, limit: int = 25) -> dict:
+        differences = self.get(end_id).compare_to(self.get(start_id), "lineno")
+        return {
+            "start": start_id,
+            "end": end_id,
+            "size_diff": sum(stat.size_diff for stat in differences),
+            "top": [
+                {
+                    "location": location(stat.traceback),
+                    "size_diff": stat.size_diff,
+                    "count_diff": stat.count_diff,
+                    "size": stat.size,
+                }
+                for stat in differences[:limit]
+            ],
+        }
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self.snapshots.clear()
+
+
+def location(traceback: tracemalloc.Traceback) -> str:
+    frame = traceback[0]
+    return f"{frame.filename}:{frame.lineno}"
+
+
+profiler = SamplingProfiler(
+    interval=PROFILE_INTERVAL_MS / 1000,
+    max_request_profiles=PROFILE_MAX_REQUEST_PROFILES,
+)
+memory_snapshots = MemorySnapshots(frames=TRACEMALLOC_FRAMES, max_snapshots=PROFILE_MAX_SNAPSHOTS)
@@ -0,0 +1,33 @@
+import redis.asyncio as redis
+
+from utils.variables import (LOGIN_ADMISSION_REDIS_TIMEOUT_MS, REDIS_ADMISSION_MAX_CONNECTIONS, REDIS_MAX_CONNECTIONS,
+                             REDIS_SERVER, REDIS_SOCKET_TIMEOUT)
+
+# One explicitly sized pool per worker, shared by every redis user in the service.
+pool = redis.ConnectionPool.from_url(
+    REDIS_SERVER,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    socket_timeout=REDIS_SOCKET_TIMEOUT
+)
+
+client = redis.Redis(connection_pool=pool)
+
+# Login admission waits milliseconds for redis, not seconds. Its own pool carries that as the socket
+# timeout, so a slow answer fails the call instead of it being cancelled, and the connections a
+# timeout drops are not taken from everyone else.
+admission_pool = redis.ConnectionPool.from_url(
+    REDIS_SERVER,
+    max_connections=REDIS_ADMISSION_MAX_CONNECTIONS,
+    socket_timeout=LOGIN_ADMISSION_REDIS_TIMEOUT_MS / 1000,
+    socket_connect_timeout=LOGIN_ADMISSION_REDIS_TIMEOUT_MS / 1000
+)
+
+admission_client = redis.Redis(connection_pool=admission_pool)
+
+
+async def close():
+    """Close the clients and disconnect the pooled connections."""
+    await client.aclose()
+    await pool.disconnect()
+    await admission_client.aclose()
+    await admission_pool.disconnect()
@@ -1,7 +1,9 @@
+from functools import lru_cache
 from typing import Dict, List, Optional, Union
 
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response
+from pydantic import BaseModel
+from pydantic_core import to_json
 
 from utils.constant import ERROR_BAD_REQUEST, SUCCESS
 
@@ -12,8 +14,7 @@ headers = {
 }
 
 
-def response(data: Optional[Union[Dict, List]], success: bool, message: Optional[str], status_code: int,
-             errors: Optional[Union[Dict, List]] = None, warning: Optional[str] = None, **kwargs):
+def envelope(data, success: bool, message: Optional[str], errors=None, warning: Optional[str] = None) -> dict:
     content = {
         "message": message,
         "success": success,
@@ -24,15 +25,35 @@ def response(data: Optional[Union[Dict, List]], success: bool, message: Optional
         content["warning"] = warning
     else:
         content["errors"] = errors
+    return content
+
+
+@lru_cache(maxsize=256)
+def static_body(success: bool, message: Optional[str]) -> bytes:
+    """Serialized envelope without data, warning or errors, built once per message."""
+    return to_json(envelope(data=None, success=success, message=message))
+
+
+def response(data: Optional[Union[Dict, List, BaseModel]], success: bool, message: Optional[str], status_code: int,
+             errors: Optional[Union[Dict, List]] = None, warning: Optional[str] = None, **kwargs):
+    """Serialize the envelope straight to bytes, pydantic models in `data` are dumped by pydantic-core.
+
+    The output matches what JSONResponse(jsonable_encoder(...)) produced, byte for byte.
+    """
+    if data is None and errors is None and warning is None and not kwargs and isinstance(message, (str, type(None))):
+        body = static_body(success, message)
+    else:
+        body = to_json(envelope(data, success, message, errors, warning), **kwargs)
 
-    return JSONResponse(
-        content=jsonable_encoder(content, **kwargs),
+    return Response(
+        content=body,
         status_code=status_code,
-        headers=headers
+        headers=headers,
+        media_type="application/json"
     )
 
 
-def success(status_code=SUCCESS, message: Optional[str] = None, data: Optional[Union[Dict, List]] = None,
+def success(status_code=SUCCESS, message: Optional[str] = None, data: Optional[Union[Dict, List, BaseModel]] = None,
             warning: Optional[str] = None, **kwargs):
     return response(data=data, success=True, message=message, status_code=status_code,
                     warning=warning, **kwargs)
@@ -6,3 +6,15 @@ engine = None
 
 # Database Session
 session = None
+
+# Async database engine
+async_engine = None
+
+# Async session factory
+async_session = None
+
+# Read replicas (ReplicaSet), None without DATABASE_REPLICA_URLS
+replicas = None
+
+# Replica health check task
+replica_monitor = None
@@ -0,0 +1,149 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import Counter
+from typing import Optional
+
+from utils import metrics
+from utils.log import StructuredMessage, logger, trace_id_var
+from utils.variables import WATCHDOG_INTERVAL_MS, WATCHDOG_STACK_LIMIT, WATCHDOG_THRESHOLD_MS
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LoopWatchdog:
+    """Measures event loop lag and reports what blocked the loop.
+
+    A ticker task records a heartbeat every `interval` seconds and measures
+    how late it woke up. A sampling thread watches the heartbeat and, once
+    it is older than `threshold`, grabs the loop thread's stack with
+    sys._current_frames() while the blocking call is still on it. The
+    ticker logs that stack with the blocked request's trace id when the
+    loop comes back, and counts the stall under its call site.
+    """
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.02, stack_limit: int = 30):
+        self.threshold = threshold
+        self.interval = interval
+        self.stack_limit = stack_limit
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.heartbeat = 0.0
+        self.ticker: Optional[asyncio.Task] = None
+        self.sampler: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        # Written by the sampling thread, consumed by the ticker.
+        self.pending: Optional[dict] = None
+        self.stalls = Counter()
+        self.max_lag = 0.0
+        # The sampling thread cannot read the loop's context vars, so requests register their task.
+        self.trace_ids = weakref.WeakKeyDictionary()
+
+    @property
+    def running(self) -> bool:
+        return self.ticker is not None
+
+    def track(self, trace_id: str) -> None:
+        """Associate the current task with `trace_id` so stalls inside it can be attributed."""
+        task = asyncio.current_task()
+        if task is not None:
+            self.trace_ids[task] = trace_id
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        self.ticker = asyncio.create_task(self.tick())
+        self.sampler = threading.Thread(target=self.sample, name="loop-watchdog", daemon=True)
+        self.sampler.start()
+
+    async def stop(self) -> None:
+        if self.ticker is None:
+            return
+        self.stopped.set()
+        self.ticker.cancel()
+        try:
+            await self.ticker
+        except asyncio.CancelledError:
+            pass
+        self.sampler.join(timeout=1)
+        self.ticker = self.sampler = None
+
+    async def tick(self) -> None:
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - self.heartbeat - self.interval, 0.0)
+            metrics.EVENT_LOOP_LAG.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self.report(lag)
+
+    def sample(self) -> None:
+        while not self.stopped.wait(self.interval):
+            beat = self.heartbeat
+            if time.monotonic() - beat - self.interval < self.threshold:
+                continue
+            if self.pending is not None and self.pending["heartbeat"] == beat:
+                continue  # already captured this stall
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            task = asyncio.current_task(self.loop)
+            self.pending = {
+                "heartbeat": beat,
+                "trace_id": self.trace_ids.get(task, "") if task is not None else "",
+                "call_site": stall_site(frame),
+                "stack": traceback.format_stack(frame, limit=self.stack_limit),
+            }
+
+    def report(self, lag: float) -> None:
+        pending, self.pending = self.pending, None
+        if pending is None:
+            # Blocked for less than a sampling interval past the threshold, nothing was captured.
+            pending = {"trace_id": "", "call_site": "unknown", "stack": []}
+
+        self.stalls[pending["call_site"]] += 1
+        metrics.EVENT_LOOP_STALLS.labels(pending["call_site"]).inc()
+
+        log_dict = {
+            "blocked_for": f"{lag:.4f}",
+            "trace_id": pending["trace_id"],
+            "call_site": pending["call_site"],
+            "stack": "".join(pending["stack"]),
+        }
+        # The ticker task has its own context, setting the trace id here only tags this log line.
+        trace_id_var.set(pending["trace_id"])
+        logger.warning(StructuredMessage("Event loop blocked", log_dict))
+        trace_id_var.set("")
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "threshold": self.threshold,
+            "max_lag": round(self.max_lag, 6),
+            "stalls": dict(self.stalls.most_common()),
+        }
+
+
+def stall_site(frame) -> str:
+    """Innermost frame of our own code on the blocked stack."""
+    innermost = frame
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(PROJECT_ROOT) and filename != __file__ and "site-packages" not in filename:
+            return f"{os.path.relpath(filename, PROJECT_ROOT)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return f"{innermost.f_code.co_filename}:{innermost.f_lineno} in {innermost.f_code.co_name}"
+
+
+watchdog = LoopWatchdog(
+    threshold=WATCHDOG_THRESHOLD_MS / 1000,
+    interval=WATCHDOG_INTERVAL_MS / 1000,
+    stack_limit=WATCHDOG_STACK_LIMIT,
+)